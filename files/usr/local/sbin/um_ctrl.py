@@ -10,39 +10,211 @@
 #
 # --------------------------------------------------------------------------
 
-VERSION=2             # increase with incompatible changes
+VERSION=10            # increase with incompatible changes (schema-version)
 
-DEFAULT_DB  = "/var/lib/uptime-manager/schedule.sqlite"
-CONFIG_FILE = "/etc/uptime-manager.json"
+DEFAULT_DB     = "/var/lib/uptime-manager/schedule.sqlite"
+DEFAULT_SOCKET = "/run/uptime-manager.sock"
+CONFIG_FILE    = "/etc/uptime-manager.json"
+BOOT_ID_FILE   = "/proc/sys/kernel/random/boot_id"
 
-TIME_HORIZON =  7     # we peek at most 7 days into the future
+HOOK_TIMEOUT = 30     # timeout for um_set_halt/um_set_boot in seconds
+BUSY_TIMEOUT = 10     # default for the setting busy_timeout in seconds
+DB_RETRIES   =  3     # number of tries to start a write-transaction
+CACHE_BUSY_TIMEOUT = 0.5  # read-only commands: wait at most 0.5 seconds to
+                          # update the cache of state-changes
+VACUUM_PAGES = 256    # free pages reclaimed by the write paths (incremental)
+
+# commands executed by the daemon (if running)
+SERVED_COMMANDS = ['add','enable','disable','del','clean','raw','list','get']
+
+# commands which need the settings from the config-file
+SETTINGS_COMMANDS = ['add','apply','enable','disable','del','clean','import',
+                     'import-ics','get','set','simulate','fleet','serve',
+                     'watch']
+
+# commands using a read-only connection (they never write to the database)
+READ_ONLY_COMMANDS = ['raw','export','list','get','simulate','fleet']
+
+# commands with a fast path (no argparse) if called without options
+# other than the timing-options
+FAST_COMMANDS = ['get','set']
+FAST_TIMINGS  = {'-T': 'text', '--timings': 'text', '--timings-json': 'json'}
+
+TIME_HORIZON     =   7  # state-changes are always calculated for 7 days
+MAX_TIME_HORIZON = 366  # default maximal lookahead (setting time_horizon)
+
+FLEET_POOL_MIN = 16     # use a process-pool for at least 16 hosts
+FLEET_SETTINGS = ['grace_boot','grace_halt','min_downtime','time_horizon',
+                  'STATE_VALUES']
+
+WATCH_DEBOUNCE  =  2    # watch: apply after 2 seconds without changes
+WATCH_MAX_DELAY = 30    # watch: apply at the latest 30 seconds after a change
+
+SIMULATE_DAYS     = 28  # simulate: default number of days
+SIMULATE_SETTINGS = ['min_downtime','grace_boot','grace_halt']
 
 # list formatting
 LIST_HEADER = "Date       |Time      |Class    | Label                | Type | Value      | State |"
 LIST_SEP    = "-----------|----------|---------|----------------------|------|------------|-------|"
 LIST_FORMAT = "{0:10} | {6:8} |{1:8} | {2:20} | {3:4} | {4:10} | {5:5} |"
 
-RAW_HEADER = "Class    | Label                | Type | Value      | State | Time     | Enabled | id"
-RAW_SEP    = "---------|----------------------|------|------------|-------|----------|---------|---------------------"
-RAW_FORMAT = "{0:8} | {1:20} | {2:4} | {3:10} | {4:5d} | {5:8} | {7:7} | {6:20d}"
+RAW_HEADER = "Class    | Label                | Type | Value      | Start    | End      | Enabled | id                   | Host"
+RAW_SEP    = "---------|----------------------|------|------------|----------|----------|---------|----------------------|-----"
+RAW_FORMAT = "{0:8} | {1:20} | {2:4} | {3:10} | {4:8} | {5:8} | {7:7} | {6:>20} | {8}"
 
 STATE_HEADER = "Date       |Time      | State"
 STATE_SEP    = "-----------|----------|------"
 STATE_FORMAT = "{0:10} | {1:8} | {2:4}"
 
-# tuple-index for rows retrieved
-TYPE_INDEX    = 3
-VALUE_INDEX   = 4
-STATE_INDEX   = 5
-STATE_INDEX_S = 2
-I_TIME  = 6
-I_DATE  = 0
+# field-names of list, raw and state-changes (in the order of the rows)
+OUTPUT_FORMATS = ['table','json','jsonl','csv']
+LIST_FIELDS    = ['date','class','label','type','value','state','time','id',
+                  'enabled']
+RAW_FIELDS     = ['class','label','type','value','start','end','id','enabled',
+                  'host']
+STATE_FIELDS   = ['date','time','state']
+
+SIMULATE_FIELDS = SIMULATE_SETTINGS + ['boots','uptime_hours',
+                                     'shortest_downtime']
+SIMULATE_HEADER = "min_downtime | grace_boot | grace_halt | Boots | Uptime (h) | Shortest downtime (min)"
+SIMULATE_SEP    = "-------------|------------|------------|-------|------------|------------------------"
+SIMULATE_FORMAT = "{0:12} | {1:10} | {2:10} | {3:5d} | {4:10.1f} | {5:>10}"
+
+FLEET_HEADER = "Host                 | Next halt           | Next boot"
+FLEET_SEP    = "---------------------|---------------------|--------------------"
+FLEET_FORMAT = "{0:20} | {1:19} | {2:19}"
+
+FLEET_LIST_HEADER = "Host                 | Entries"
+FLEET_LIST_SEP    = "---------------------|--------"
+FLEET_LIST_FORMAT = "{0:20} | {1:7d}"
+
+# schema-migrations: version -> list of sql-statements or functions(cursor)
+MIGRATIONS = {
+  3: ["CREATE TABLE IF NOT EXISTS meta (key text primary key, value)",
+      """CREATE INDEX IF NOT EXISTS idx_schedule_lookup
+           ON schedule (enabled,type,value,time)""",
+      "CREATE INDEX IF NOT EXISTS idx_schedule_id ON schedule (id)",
+      "CREATE INDEX IF NOT EXISTS idx_schedule_class ON schedule (class,label)"
+      ],
+  4: ["""CREATE TABLE IF NOT EXISTS state_cache
+           (seq integer primary key,
+            day text,
+            time text,
+            state integer,
+            candidate integer)""",
+      "INSERT OR IGNORE INTO meta VALUES ('generation',0)"
+      ],
+  5: [lambda cursor: migrate_integer_schedule(cursor),
+      "DROP TABLE state_cache",
+      """CREATE TABLE state_cache
+           (seq integer primary key,
+            day integer,
+            time integer,
+            state integer,
+            candidate integer)""",
+      "DELETE FROM meta where key='cache_day'"
+      ],
+  6: ["ALTER TABLE schedule ADD COLUMN host text",
+      "CREATE INDEX IF NOT EXISTS idx_schedule_host ON schedule (host,enabled)"
+      ],
+  7: ["""CREATE TABLE IF NOT EXISTS classes
+           (class text primary key,
+            enabled integer)""",
+      # classes with all entries disabled are disabled in the classes-table
+      """INSERT OR REPLACE INTO classes
+           SELECT class,max(enabled) FROM schedule GROUP BY class""",
+      """UPDATE schedule SET enabled=1
+           WHERE class IN (SELECT class FROM classes WHERE enabled=0)"""
+      ],
+  8: ["PRAGMA auto_vacuum=INCREMENTAL"],
+  9: [lambda cursor: migrate_rule_schedule(cursor),
+      "CREATE INDEX IF NOT EXISTS idx_schedule_id ON schedule (id)",
+      "CREATE INDEX IF NOT EXISTS idx_schedule_class ON schedule (class,label)",
+      "CREATE INDEX IF NOT EXISTS idx_schedule_host ON schedule (host,enabled)"
+      ],
+  10: ["ALTER TABLE schedule ADD COLUMN since integer"]
+  }
+
+# steps executed after the migration-transaction (VACUUM needs autocommit)
+MIGRATIONS_POST = {
+  8: ["VACUUM"]                 # auto_vacuum only changes with a VACUUM
+  }
+
+# index of the schedule-table (dropped when recreating the table in 5)
+SCHEDULE_INDEXES = [
+  """CREATE INDEX IF NOT EXISTS idx_schedule_lookup
+       ON schedule (enabled,type,value,time)""",
+  "CREATE INDEX IF NOT EXISTS idx_schedule_id ON schedule (id)",
+  "CREATE INDEX IF NOT EXISTS idx_schedule_class ON schedule (class,label)"
+  ]
+
+# increase generation of the schedule (invalidates the cache)
+BUMP_GENERATION_STMT = "UPDATE meta SET value=value+1 where key='generation'"
+
+# delete expired entries (entries ending before a given epoch-day: an
+# interval spanning midnight still runs on the day after until)
+EXPIRE_STMT = """DELETE FROM schedule
+                   where until < ?1-1 or until = ?1-1 and end >= start"""
+
+# replace the row of an entry
+PRE_INSERT_STMT = 'DELETE FROM schedule where id=?'
+INSERT_STMT     = 'INSERT INTO schedule VALUES (' + 10 * '?,' + '?)'
+
+# entries of the schedule (host is NULL for entries valid for all hosts).
+# An entry is enabled if the entry and its class are enabled.
+SCHEDULE_SELECT = """select s.class,label,type,value,since,until,start,end,id,
+                            s.enabled*coalesce(c.enabled,1),host
+                       from schedule s left join classes c
+                         on c.class = s.class"""
+
+# condition for rows of enabled classes (the classes-table is small, the
+# subquery is only evaluated once)
+CLASS_ENABLED = "class not in (select class from classes where enabled = 0)"
+
+# import/export: fields of an entry and number of entries per batch
+TRANSFER_FORMATS = ['jsonl','csv']
+TRANSFER_FIELDS  = ['class','label','type','value','interval','enabled','id',
+                    'host']
+IMPORT_BATCH     = 1000
+
+# import-ics: weekdays of BYDAY and supported parts of an RRULE
+ICS_DAYS  = {'MO': 1, 'TU': 2, 'WE': 3, 'TH': 4, 'FR': 5, 'SA': 6, 'SU': 7}
+ICS_RRULE = ['FREQ','INTERVAL','BYDAY','BYMONTHDAY','UNTIL','COUNT','WKST']
+
+# enabled rows of a host for the evaluation (without DATE-entries ending
+# before the day before ?2, intervals might span midnight). The union of the
+# two selects allows the use of idx_schedule_host.
+AGGREGATE_WHERE = ("enabled = 1 and (until is null or until >= ?2-1) and " +
+                   CLASS_ENABLED)
+AGGREGATE_STMT  = """
+  select {0} from schedule
+    where host is null and """ + AGGREGATE_WHERE + """{1}
+  union all
+  select {0} from schedule
+    where host = ?1 and """ + AGGREGATE_WHERE + "{1}"
+
+# columns of the rows evaluated by occurrences() (fetch_uptimes also
+# needs the columns for the output)
+AGGREGATE_COLS     = "type,value,since,until,start,end"
+FETCH_UPTIMES_COLS = AGGREGATE_COLS + ",class,label,id,enabled"
+
+# additional condition for a short range of days (?3 is the last day): single
+# days must match the weekdays {0} or days of month {1} of the range
+FETCH_UPTIMES_WHERE = """ and (typeof(value) = 'text' or
+    type = 'DATE' and value <= ?3 or
+    type = 'DOW' and value in ({0}) or type = 'DOM' and value in ({1}))"""
+
+EPOCH_ORDINAL = 719163    # datetime.date(1970,1,1).toordinal()
 
 
 # --- system-imports   -----------------------------------------------------
 
-import argparse
-import sys, os, datetime, sqlite3, locale, json, hashlib, shlex
+import time
+T_START = time.perf_counter()       # start of the program (for --timings)
+
+import sys, os, datetime, sqlite3, contextlib, collections
+
+# all other modules are imported on first use (see lazy_import)
 
 # ---------------------------------------------------------------------------
 # --- helper-class for options   --------------------------------------------
@@ -66,12 +238,17 @@ class Msg(object):
     }
   def __init__(self,level):
     self._level = level
+    self.last_error = None
 
   # --- print a message   ---------------------------------------------------
   
-  def msg(self,msg_level,text,nl=True):
-    """ print message """
+  def msg(self,msg_level,text,*args,nl=True):
+    """ print message (text is only formatted with args if level is active) """
+    if msg_level == "ERROR":
+      self.last_error = text % args if args else text
     if Msg.MSG_LEVELS[msg_level] >= Msg.MSG_LEVELS[self._level]:
+      if args:
+        text = text % args
       if nl:
         now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         sys.stderr.write("[" + msg_level + "] " + "[" + now + "] " + text + "\n")
@@ -85,6 +262,83 @@ class Msg(object):
     """ return True if msg_level is at least self._level """
     return Msg.MSG_LEVELS[msg_level] >= Msg.MSG_LEVELS[self._level]
 
+# ---------------------------------------------------------------------------
+# --- helper-class for timings   --------------------------------------------
+
+class Timings(object):
+  """ collect wall-times of the phases of a program-run
+
+      Phases are always recorded (this is cheap), the report is only
+      printed if a format is set.
+  """
+
+  def __init__(self,fmt=None,start=None):
+    self.fmt     = fmt
+    self._start  = T_START if start is None else start
+    self._phases = []              # list of (name,offset,seconds)
+
+  # --- time a phase   ------------------------------------------------------
+
+  @contextlib.contextmanager
+  def phase(self,name):
+    """ context-manager timing the phase """
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self._phases.append((name,start-self._start,time.perf_counter()-start))
+
+  # --- add a phase   -------------------------------------------------------
+
+  def add(self,name,seconds):
+    """ add a phase with known duration (ending now) """
+    end = time.perf_counter() - self._start
+    self._phases.append((name,end-seconds,seconds))
+
+  # --- report timings   ----------------------------------------------------
+
+  def report(self):
+    """ print timings to stderr (human-readable or json) """
+    if not self.fmt:
+      return
+    total = time.perf_counter() - self._start
+    if self.fmt == 'json':
+      json = lazy_import('json')
+      sys.stderr.write(json.dumps(
+        {'phases': [{'phase': name,
+                     'at_ms': round(1000*offset,3),
+                     'ms': round(1000*secs,3)}
+                    for name,offset,secs in self._phases],
+         'total_ms': round(1000*total,3)})+"\n")
+    else:
+      sys.stderr.write("%-24s %10s %10s\n" % ("phase","at [ms]","[ms]"))
+      for name,offset,secs in self._phases:
+        sys.stderr.write("%-24s %10.3f %10.3f\n" %
+                         (name,1000*offset,1000*secs))
+      sys.stderr.write("%-24s %10s %10.3f\n" % ("total","",1000*total))
+
+# timings of this program-run
+timings = Timings()
+
+# default logger (replaced by main, the daemon and UptimeManager)
+logger = Msg("NONE")
+
+# --- import a module on first use   ----------------------------------------
+
+def lazy_import(name):
+  """ import a module on first use and record the import-time
+
+      Commands only import what they need, this keeps the startup of
+      e.g. 'set halt' at boot-time short.
+  """
+
+  module = sys.modules.get(name)
+  if module is None:
+    with timings.phase("import %s" % name):
+      __import__(name)
+    module = sys.modules[name]                # submodule for dotted names
+  return module
+
 # ---------------------------------------------------------------------------
 
 # --- isoweekday of given date   --------------------------------------------
@@ -99,8 +353,9 @@ def dow(date):
 def dow_map():
   """ return localized day-of-week map """
 
+  init_locale()
   result = {}
-  day   = datetime.datetime.strptime("01.01.2000","%d.%M.%Y")
+  day   = datetime.date(2000,1,1)
   delta = datetime.timedelta(days=1)
   for _ in range(7):
     result[str(dow(day))] = day.strftime("%A")
@@ -109,12 +364,14 @@ def dow_map():
 
 # day-of-week text
 
-# --- day of month of given date   ------------------------------------------
+# --- set locale   ----------------------------------------------------------
 
-def dom(date):
-  """ return day of given date """
+def init_locale():
+  """ set locale from the environment (only needed for localized
+      input and output, so this is not done at startup) """
 
-  return date.day
+  locale = lazy_import('locale')
+  locale.setlocale(locale.LC_ALL, '')
 
 # --- convert date to sql-date   --------------------------------------------
 
@@ -130,68 +387,226 @@ def sql2date(date):
 
   return date.strptime(date,"%Y-%m-%d")
 
-# --- convert sql-date and time to datetime   ------------------------------
+# --- convert date to epoch-day   ------------------------------------------
 
-def sql2datetime(date,time):
-  """ return date of given sql-date """
+def date2day(date):
+  """ return epoch-day (days since 1970-01-01) of given date """
+
+  return date.toordinal() - EPOCH_ORDINAL
+
+# --- convert epoch-day to date   -------------------------------------------
+
+def day2date(day):
+  """ return date of given epoch-day """
+
+  return datetime.date.fromordinal(day + EPOCH_ORDINAL)
+
+# --- convert epoch-day to sql-date   ---------------------------------------
+
+def day2sql(day):
+  """ return sql-date of given epoch-day """
+
+  return date2sql(day2date(day))
+
+# --- convert sql-date to epoch-day   ---------------------------------------
+
+def sql2day(date):
+  """ return epoch-day of given sql-date (yyyy-mm-dd) """
+
+  return date2day(datetime.date(int(date[0:4]),int(date[5:7]),
+                                int(date[8:10])))
+
+# --- convert time to seconds of day   --------------------------------------
+
+def time2secs(time):
+  """ return seconds of day of given time (hh:mm[:ss]) """
+
+  parts = [int(p) for p in time.split(":")]
+  return 3600*parts[0] + 60*parts[1] + (parts[2] if len(parts) > 2 else 0)
+
+# --- convert seconds of day to time   --------------------------------------
 
-  return datetime.datetime.strptime("%s %s" % (date,time), "%Y-%m-%d %H:%M:%S")
+def secs2time(secs):
+  """ return time (hh:mm:ss) of given seconds of day """
+
+  return "%02d:%02d:%02d" % (secs // 3600,(secs // 60) % 60,secs % 60)
+
+# --- seconds of day of a datetime   ---------------------------------------
+
+def secs_of_day(dt):
+  """ return seconds of day of given datetime """
+
+  return 3600*dt.hour + 60*dt.minute + dt.second
+
+# --- host to evaluate   ----------------------------------------------------
+
+def eval_host(options):
+  """ return host for the evaluation of the schedule (default: this host) """
+
+  return options.host or os.uname().nodename
 
 # --- open database   -------------------------------------------------------
 
 def open_db(options):
-  """ open database and return reference """
+  """ open database and return reference
+
+      The connection is shared for the whole run of the program, so
+      subsequent calls just return the already open connection.
+      Commands which only read use a read-only connection, all other
+      connections switch the database to WAL-mode, so readers and the
+      (single) writer don't block each other. See open_db_read_only for
+      users without write-access.
+  """
 
-  logger.msg("DEBUG","opening database: %s" % options.db_name)
+  if getattr(options,'db',None):
+    return options.db
+
+  read_only = getattr(options,'read_only',False)
+  timeout   = getattr(options,'busy_timeout',BUSY_TIMEOUT)
+  logger.msg("DEBUG","opening database: %s (%s)",options.db_name,
+             "read-only" if read_only else "read-write")
   try:
-    options.db = sqlite3.connect(options.db_name,
-                                 detect_types=sqlite3.PARSE_DECLTYPES)
+    with timings.phase("open database"):
+      if read_only:
+        options.db = open_db_read_only(options.db_name,timeout)
+      else:
+        options.db = sqlite3.connect(options.db_name,timeout=timeout,
+                                     detect_types=sqlite3.PARSE_DECLTYPES)
+        options.db.execute("PRAGMA journal_mode=WAL")
     return options.db
   except Exception as e:
-    logger.msg("ERROR","Exception: %s" % e)
-    return None
+    logger.msg("ERROR","cannot open database %s: %s",options.db_name,e)
+    sys.exit(3)
+
+# --- open database read-only   --------------------------------------------
+
+def open_db_read_only(db_name,timeout):
+  """ return read-only connection
+
+      Reading a database in WAL-mode needs write-access to the -shm file
+      (or to the directory, if it does not exist). Without it, a writable
+      database is opened read-write and a database without pending
+      changes in the -wal file is opened as immutable.
+  """
+
+  path = db_name
+  for c,quoted in [('%','%25'),('?','%3f'),('#','%23')]:
+    path = path.replace(c,quoted)
+  db = sqlite3.connect("file:%s?mode=ro" % path,uri=True,timeout=timeout,
+                       detect_types=sqlite3.PARSE_DECLTYPES)
+  try:
+    db.execute("select count(*) from sqlite_master").fetchone()
+    return db
+  except sqlite3.Error as e:
+    db.close()
+    error = e
+
+  wal = db_name + "-wal"
+  if os.access(db_name,os.W_OK) and os.access(
+      os.path.dirname(os.path.abspath(db_name)),os.W_OK):
+    logger.msg("DEBUG","cannot read database read-only (%s), using "
+               "read-write connection",error)
+    return sqlite3.connect(db_name,timeout=timeout,
+                           detect_types=sqlite3.PARSE_DECLTYPES)
+  elif not os.path.exists(wal) or not os.path.getsize(wal):
+    logger.msg("DEBUG","cannot read database read-only (%s), reading it "
+               "as immutable",error)
+    db = sqlite3.connect("file:%s?mode=ro&immutable=1" % path,uri=True,
+                         timeout=timeout,detect_types=sqlite3.PARSE_DECLTYPES)
+    db.execute("select count(*) from sqlite_master").fetchone()
+    return db
+  raise sqlite3.OperationalError("%s (reading a database in WAL-mode needs "
+                                 "write-access to its directory or read-access "
+                                 "to its -shm file)" % error)
+
+# --- start a write-transaction   -------------------------------------------
+
+def begin_write(options):
+  """ start a write-transaction and return a cursor
+
+      BEGIN IMMEDIATE takes the write-lock up front, so the statements of
+      the transaction will not fail because the database is locked. sqlite
+      itself waits up to busy_timeout seconds for the lock, we try
+      DB_RETRIES times before we give up.
+  """
 
-# --- close database   -------------------------------------------------------
+  cursor = open_db(options).cursor()
+  for attempt in range(1,DB_RETRIES+1):
+    try:
+      cursor.execute("BEGIN IMMEDIATE")
+      return cursor
+    except sqlite3.OperationalError as oe:
+      if attempt == DB_RETRIES or "locked" not in str(oe):
+        raise
+      logger.msg("WARN","database is locked, retrying (%d/%d)",
+                 attempt,DB_RETRIES-1)
+
+# --- close database   ------------------------------------------------------
 
 def close_db(options):
   """ close database """
 
+  if not getattr(options,'db',None):
+    return
+
   logger.msg("DEBUG","closing database")
   try:
     options.db.close()
     options.db = None
   except Exception as e:
-    logger.msg("ERROR","Exception: %s" % e)
+    logger.msg("ERROR","Exception: %s",e)
 
 # --- execute a statement   -------------------------------------------------
 
 def exec_sql(options,statement,args=(),commit=False):
-  """ execute an sql-statement """
+  """ execute an sql-statement (exits on errors, changes are never dropped) """
 
-  logger.msg("DEBUG","executing: %s" % statement)
-  logger.msg("DEBUG","args: %r" % (args,))
+  logger.msg("DEBUG","executing: %s",statement)
+  logger.msg("DEBUG","args: %r",args)
   try:
-    open_db(options)
-    cursor = options.db.cursor()
-    cursor.execute(statement,args)
     if commit:
-      options.db.commit()
-    close_db(options)
-  except sqlite3.OperationalError as oe:
-    logger.msg("ERROR","SQL-error: %s" % oe)
-  except Exception as e:
-    logger.msg("ERROR","Exception: %s" % e)
+      with open_db(options):
+        begin_write(options).execute(statement,args)
+    else:
+      open_db(options).execute(statement,args)
+  except sqlite3.Error as e:
+    logger.msg("ERROR","SQL-error: %s",e)
+    sys.exit(3)
+
+# --- execute a batch of statements   ---------------------------------------
+
+def exec_batch(options,batch):
+  """ execute a list of (statement,rows) within a single transaction
+
+      Every statement is executed with executemany() for all of its rows,
+      the transaction is committed once at the end (or rolled back on errors).
+      Errors are fatal: the caller must not assume the changes were applied.
+  """
+
+  try:
+    with open_db(options):
+      cursor = begin_write(options)
+      for statement,rows in batch:
+        logger.msg("DEBUG","executing: %s",statement)
+        logger.msg("DEBUG","rows: %d",len(rows))
+        cursor.executemany(statement,rows)
+    options.timeline = None
+  except sqlite3.Error as e:
+    logger.msg("ERROR","SQL-error: %s (nothing changed)",e)
+    sys.exit(3)
 
 # --- create the database   -------------------------------------------------
 
 def do_create(options):
   """ create the database """
-  logger.msg("INFO","creating database %s" % options.db_name)
+  logger.msg("INFO","creating database %s",options.db_name)
   
-  open_db(options)
-  cursor = options.db.cursor()
+  cursor = open_db(options).cursor()
 
   cursor.execute("DROP TABLE IF EXISTS schedule")
+  cursor.execute("DROP TABLE IF EXISTS meta")
+  cursor.execute("DROP TABLE IF EXISTS state_cache")
+  cursor.execute("DROP TABLE IF EXISTS classes")
   cursor.execute("""CREATE TABLE schedule
       (class text,
        label text,
@@ -201,7 +616,148 @@ def do_create(options):
        time  text,
        id integer,
        enabled integer)""")
-  close_db(options)
+
+  # upgrade initial schema to the current version
+  do_migrate(options)
+
+# --- query schema-version of the database   --------------------------------
+
+def get_schema_version(options):
+  """ return schema-version of the database (0 if there is no schema) """
+
+  cursor = open_db(options).cursor()
+  try:
+    try:
+      cursor.execute("select value from meta where key='version'")
+      row = cursor.fetchone()
+      return row[0] if row else 2
+    except sqlite3.OperationalError:
+      # no meta-table: either a database without schema or an old version
+      cursor.execute("""select count(*) from sqlite_master
+                          where type='table' and name='schedule'""")
+      return 2 if cursor.fetchone()[0] else 0
+  except sqlite3.Error as e:
+    logger.msg("ERROR","cannot read database %s: %s",options.db_name,e)
+    sys.exit(3)
+
+# --- migrate schedule to integer values and times   -----------------------
+
+def migrate_integer_schedule(cursor):
+  """ migrate schedule: values of DATE-entries to epoch-days, times to
+      seconds of day and values of DOW/DOM-entries to integers """
+
+  cursor.execute("ALTER TABLE schedule RENAME TO schedule_text")
+  cursor.execute("""CREATE TABLE schedule
+      (class text,
+       label text,
+       type  text,
+       value integer,
+       state integer,
+       time  integer,
+       id integer,
+       enabled integer)""")
+  rows = cursor.execute("select * from schedule_text").fetchall()
+  cursor.executemany("INSERT INTO schedule VALUES (" + 7 * "?," + "?)",
+    [(cls,label,dtype,sql2day(value) if dtype == 'DATE' else int(value),
+      state,time2secs(time),id,enabled)
+     for (cls,label,dtype,value,state,time,id,enabled) in rows])
+  cursor.execute("DROP TABLE schedule_text")
+  for statement in SCHEDULE_INDEXES:
+    cursor.execute(statement)
+
+# --- migrate schedule to a single row per entry   --------------------------
+
+def migrate_rule_schedule(cursor):
+  """ migrate schedule: a single row per entry with the start and the end
+      of the interval instead of a row per state-change. DATE-entries get
+      their last day (until). """
+
+  itertools = lazy_import('itertools')
+  cursor.execute("ALTER TABLE schedule RENAME TO schedule_rows")
+  cursor.execute("""CREATE TABLE schedule
+      (class text,
+       label text,
+       type  text,
+       value integer,
+       until integer,
+       start integer,
+       end   integer,
+       id integer,
+       enabled integer,
+       host text)""")
+  rows = cursor.execute("""select class,label,type,value,state,time,id,
+                                  enabled,host
+                             from schedule_rows order by id""").fetchall()
+  cursor.executemany("INSERT INTO schedule VALUES (" + 9 * "?," + "?)",
+    [join_rows(list(rows)) for _,rows in
+     itertools.groupby(rows,key=lambda row: row[6])])
+  cursor.execute("DROP TABLE schedule_rows")
+
+# --- join the rows of an entry   -------------------------------------------
+
+def join_rows(rows):
+  """ join the rows of an entry (same id, schema-version 8) to a single row
+
+      A split interval is joined again: the second part is the one starting
+      at midnight.
+  """
+
+  parts = {}
+  for (cls,label,dtype,value,state,time,id,enabled,host) in rows:
+    parts.setdefault(value,[None,None])[1-state] = time
+  if len(parts) == 1:
+    value,(start,end) = parts.popitem()
+  else:
+    (value,(start,_)),(_,(_,end)) = sorted(parts.items(),
+                                           key=lambda part: -part[1][0])
+  until = value if dtype == 'DATE' else None
+  return (cls,label,dtype,value,until,start,end,id,enabled,host)
+
+# --- migrate database to the current schema-version   ----------------------
+
+def do_migrate(options):
+  """ migrate database in place to the current schema-version """
+
+  version = get_schema_version(options)
+  if version == 0:
+    logger.msg("ERROR","no schedule in database %s (use create)",
+               options.db_name)
+    sys.exit(3)
+  elif version > VERSION:
+    logger.msg("ERROR","database-version %d is newer than program-version %d",
+               version,VERSION)
+    sys.exit(3)
+  elif version == VERSION:
+    logger.msg("DEBUG","database-version %d is current",version)
+    return
+
+  if getattr(options,'read_only',False):
+    # reopen read-write for the migration
+    close_db(options)
+    options.read_only = False
+
+  db = open_db(options)
+  try:
+    cursor = begin_write(options)
+    for v in range(version+1,VERSION+1):
+      logger.msg("INFO","migrating database to version %d",v)
+      for step in MIGRATIONS.get(v,[]):
+        if callable(step):
+          step(cursor)
+        else:
+          logger.msg("DEBUG","executing: %s",step)
+          cursor.execute(step)
+    cursor.execute("INSERT OR REPLACE INTO meta VALUES ('version',?)",
+                   (VERSION,))
+    db.commit()
+    for v in range(version+1,VERSION+1):
+      for step in MIGRATIONS_POST.get(v,[]):
+        logger.msg("DEBUG","executing: %s",step)
+        db.execute(step)
+  except Exception as e:
+    db.rollback()
+    logger.msg("ERROR","migration failed: %s",e)
+    sys.exit(3)
 
 # --- add an uptime-entry to the database   ---------------------------------
 
@@ -213,210 +769,674 @@ def do_add(options):
 
       type is one of DOW/DOM/DATE
 
-      DOW = Day-of-Week:  1-7 Monday-Sunday
-      DOM = Day-of-Month: 1-31
+      DOW  = Day-of-Week:  1-7 Monday-Sunday, sets like 1-5 or 1,3,5 and
+                           every N-th week: 1-5/2, 1-5/2+1 (the number of
+                           the week since 1970 modulo N is 0 or 1)
+      DOM  = Day-of-Month: 1-31, L (last day) and sets like 1,15 or 25-L
+      DATE = dd.mm.yyyy or a range dd.mm.yyyy-dd.mm.yyyy
+
+      DOW- and DOM-values are limited to a range of dates with a suffix
+      like @01.11.2026-31.03.2027 (both ends are optional).
+      An entry is a single row, whatever the number of days.
   """
 
   # check if input is on the commandline or from stdin
   if len(options.args) == 0:
     logger.msg("WARN","add: no arguments for add command (nothing added)")
+    return
   elif options.args[0] == '-':
     logger.msg("INFO","add: parsing new entries from stdin")
-    # read from stdin
-    for line in sys.stdin:
-      if len(line) < 2 or line[0] == '#':
-        # ignore empty lines or comments
-        continue
-      args = shlex.split(line)[:5] # strip of extra stuff (e.g. comments)
-      do_add_sql(options,args)
+    do_add_sql(options,list(add_lines(sys.stdin)))
   else:
     # use commandline arguments
     logger.msg("INFO","add: parsing new entries from the commandline")
-    do_add_sql(options,options.args)
+    do_add_sql(options,[options.args])
 
   if options.auto_set:
     logger.msg("INFO","add: automatically updating next halt and boot")
-    options.args = ['halt']
+    options.args = ['both']
     do_set(options)
-    options.args = ['boot']
+
+# --- read entries in the format of add   -----------------------------------
+
+def add_lines(f):
+  """ yield arguments of the entries of a file (one entry per line) """
+
+  shlex = lazy_import('shlex')
+  for line in f:
+    if len(line) < 2 or line[0] == '#':
+      # ignore empty lines or comments
+      continue
+    yield shlex.split(line)[:5]   # strip of extra stuff (e.g. comments)
+
+# --- apply a desired state   -----------------------------------------------
+
+def do_apply(options):
+  """ reconcile the entries with a file of entries (format of add)
+
+      The file is the desired state: entries (of --host and the given
+      classes, default: all classes) which are not in the file are
+      deleted, missing entries are added. Unchanged entries are not
+      written at all (ids are hashes of the content). With --dry-run the
+      differences are only printed.
+  """
+
+  if not options.args:
+    print("the apply command needs a file (or - for stdin)")
+    return
+  fname,classes = options.args[0],options.args[1:]
+  logger.msg("INFO","apply: reading entries from %s",
+             "stdin" if fname == '-' else fname)
+  try:
+    with transfer_file(fname,"r") as f:
+      id_row = dict(entry2row(sql_args,host=options.host)
+                    for sql_args in add_lines(f)
+                    if not classes or sql_args[0] in classes)
+  except OSError as e:
+    logger.msg("ERROR","apply: %s (nothing applied)",e)
+    sys.exit(3)
+  except (ValueError,IndexError) as e:
+    logger.msg("ERROR","apply: invalid entry: %s (nothing applied)",e)
+    sys.exit(3)
+
+  scope = ("" if not classes else
+           " and class in (%s)" % ",".join(len(classes)*"?"))
+  if sync_entries(options,"apply",id_row,scope,classes) and options.auto_set:
+    logger.msg("INFO","apply: automatically updating next halt and boot")
+    options.args = ['both']
     do_set(options)
 
-# --- add an uptime-entry to the database   ---------------------------------
+# --- synchronize entries   -------------------------------------------------
+
+def sync_entries(options,cmd,id_row,scope,args,batch=None):
+  """ replace the entries of --host (and the scope, a condition with the
+      arguments args) by the rows of id_row, writing only the differences
+      (and the statements of batch) in a single transaction.
+
+      Returns True if entries changed. With --dry-run, the differences
+      are printed instead.
+  """
 
-def do_add_sql(options,sql_args):
-  """ add an entry to the database """
-  logger.msg("DEBUG","adding entry to the database")
+  db = open_db(options)
+  old_ids = set(id for (id,) in db.execute(
+    "select id from schedule where host is ?" + scope,[options.host]+args))
+  new  = [row for id,row in id_row.items() if id not in old_ids]
+  gone = [(id,) for id in old_ids if id not in id_row]
+  logger.msg("INFO","%s: %d new, %d deleted, %d unchanged entries",
+             cmd,len(new),len(gone),len(id_row)-len(new))
+
+  if options.dry_run:
+    shlex = lazy_import('shlex')
+    gone_rows = [db.execute(SCHEDULE_SELECT + " where id=?",id).fetchone()
+                 for id in gone]
+    new_rows  = [row[:4] + row[10:] + row[4:10] for row in new]
+    for sign,rows in [('-',gone_rows),('+',new_rows)]:
+      for row in sorted(rows,key=lambda row: (row[0],row[1],row[6])):
+        record = row2record(row)
+        print(sign," ".join(shlex.quote(str(record[field]))
+                           for field in TRANSFER_FIELDS[:5]))
+    return False
+
+  if new or gone:
+    batch = (batch or []) + [(PRE_INSERT_STMT,gone),(INSERT_STMT,new),
+                             (BUMP_GENERATION_STMT,[()])]
+    batch += expire_batch(options)
+  if batch:
+    exec_batch(options,batch)
+    vacuum_db(options,VACUUM_PAGES)
+  return bool(new or gone)
+
+# --- convert arguments of an uptime-entry to a row   -----------------------
+
+def entry2row(sql_args,id=None,enabled=1,host=None):
+  """ convert arguments of an entry to the id and the row of the database
+
+      Intervals spanning midnight are not split, this is done during
+      evaluation (see occurrences).
+  """
 
-  # calculate id of arguments
+  # calculate id of arguments and host (unless given, e.g. from an import)
   sql_args[2] = sql_args[2].upper()
-  id = int(hashlib.sha256(''.join(sql_args).encode('utf-8')).
-           hexdigest()[:16],16)-2**63
-
-  logger.msg("TRACE","sql_args: %r" % sql_args)
-  PRE_INSERT_STMT = 'DELETE FROM schedule where id=?'
-  INSERT_STMT     = 'INSERT INTO schedule VALUES (' + 7 * '?,' + '?)'
-
-  # split interval
-  start,end = sql_args[4].split("-")
-  # add seconds if not specified
-  if len(start) == 5:
-    start = "%s:00" % start
-  if len(end) == 5:
-    end   = "%s:00" % end
-
-  # convert date
+  if id is None:
+    hashlib = lazy_import('hashlib')
+    key = ''.join(sql_args) + (host or '')
+    id  = int(hashlib.sha256(key.encode('utf-8')).hexdigest()[:16],16)-2**63
+
+  logger.msg("TRACE","sql_args: %r",sql_args)
+
+  # split interval and convert to seconds of day
+  start,end = [time2secs(t) for t in sql_args[4].split("-")]
+
+  # convert value (rules to normalized text, DATE to epoch-days)
   dtype = sql_args[2]
-  if dtype == 'DATE':
-    sep = sql_args[3][2]
-    parts=sql_args[3].split(sep)
-    if len(parts[2]) == 2:
-      parts[2] = "20%s" % parts[2]
-    value = "%s-%s-%s" % (parts[2],parts[1],parts[0])
+  value,since,until = parse_value(dtype,sql_args[3])
+
+  return id,(sql_args[0],sql_args[1],dtype,value,until,start,end,id,enabled,
+             host,since)
+
+# --- parse value of an entry   ---------------------------------------------
+
+def parse_value(dtype,text):
+  """ return (value,since,until) for the database
+
+      Single days are stored as integers (DATE as epoch-day), other rules
+      as normalized text. since and until are the first and last epoch-day
+      of the entry (or None). DOW- and DOM-rules take them from an optional
+      suffix @dd.mm.yyyy-dd.mm.yyyy (both ends are optional, the separator
+      of the dates must not be '-').
+  """
+
+  if dtype in ['DOW','DOM']:
+    text,_,bounds = text.partition('@')
+    since,_,until = bounds.partition('-')
+    since = parse_date(since) if since else None
+    until = parse_date(until) if until else None
+    if None not in [since,until] and until < since:
+      raise ValueError("invalid range of dates: %s" % bounds)
+    return format_rule(dtype,*parse_rule(dtype,text)),since,until
+  elif dtype == 'DATE':
+    parts = text.split('-')
+    if text[2] != '-':
+      dates = parts
+    elif len(parts) == 6:
+      dates = ['-'.join(parts[:3]),'-'.join(parts[3:])]
+    else:
+      dates = [text]
+    days = [parse_date(date) for date in dates]
+    if len(days) > 2 or days[-1] < days[0]:
+      raise ValueError("invalid range of dates: %s" % text)
+    return days[0],None,days[-1]
   else:
-    value = sql_args[3]
+    raise ValueError("invalid type: %s" % dtype)
 
-  # check if time-span overlapps midnight. Split if necessary
-  if end < start:
-    start2 = '00:00:00'
-    end2   = end
-    end    = '23:59:59'
-    value2 = next_day(dtype,value)  # next value of given dtype
+# --- parse a date   --------------------------------------------------------
+
+def parse_date(text):
+  """ return epoch-day of dd.mm.yyyy (any separator, yy is 20yy) """
+
+  parts = text.split(text[2])
+  if len(parts[2]) == 2:
+    parts[2] = "20%s" % parts[2]
+  return date2day(datetime.date(int(parts[2]),int(parts[1]),int(parts[0])))
+
+# --- parse a DOW/DOM-rule   ------------------------------------------------
+
+def parse_rule(dtype,value):
+  """ return (days,every,phase) of a DOW- or DOM-value (int or text)
+
+      days is a sorted tuple of weekdays or days of month (32 is the last
+      day of the month), a DOW-rule is valid in weeks with
+      epoch-week % every == phase. Weeks start on monday.
+  """
+
+  if isinstance(value,int):
+    days,last_day,every,phase = [value],False,1,0
   else:
-    start2 = None
+    days,_,step = value.upper().partition('/')
+    every,_,phase = step.partition('+')
+    every,phase = int(every or 1),int(phase or 0)
+    items,days,last_day = days.split(','),[],False
+    for item in items:
+      first,_,last = item.strip().partition('-')
+      if first == 'L' and not last and dtype == 'DOM':
+        last_day = True
+      else:
+        last = 31 if last == 'L' and dtype == 'DOM' else int(last or first)
+        days.extend(range(int(first),last+1))
+
+  top = 7 if dtype == 'DOW' else 31
+  if (not (days or last_day) or min(days or [1]) < 1 or max(days or [1]) > top
+      or every < 1 or not 0 <= phase < every or
+      (every > 1 and dtype != 'DOW')):
+    raise ValueError("invalid %s-value: %s" % (dtype,value))
+  return tuple(sorted(set(days)) + ([32] if last_day else [])),every,phase
+
+# --- format a DOW/DOM-rule   -----------------------------------------------
+
+def format_rule(dtype,days,every,phase):
+  """ return normalized value of a rule (int for a single day) """
+
+  if len(days) == 1 and every == 1 and days[0] != 32:
+    return days[0]
+
+  # runs of at least three days are written as range
+  items,i = [],0
+  while i < len(days):
+    j = i
+    while j+1 < len(days) and days[j+1] == days[j]+1 and days[j+1] != 32:
+      j += 1
+    if j-i >= 2:
+      items.append("%d-%d" % (days[i],days[j]))
+    else:
+      items.extend(str(day) for day in days[i:j+1])
+    i = j+1
+  text = ",".join(items) if items[-1] != "32" else ",".join(items[:-1]+["L"])
+  if every > 1:
+    text += "/%d" % every + ("+%d" % phase if phase else "")
+  return text
+
+# --- add uptime-entries to the database   ----------------------------------
+
+def do_add_sql(options,entries):
+  """ add a list of entries to the database (single transaction)
+
+      Returns the ids of the entries.
+  """
+  logger.msg("DEBUG","adding %d entries to the database",len(entries))
+
+  # collect row per id (duplicate entries are only added once)
+  try:
+    id_row = dict(entry2row(sql_args,host=options.host)
+                  for sql_args in entries)
+  except (ValueError,IndexError) as e:
+    logger.msg("ERROR","add: invalid entry: %s (nothing added)",e)
+    sys.exit(3)
+
+  # remove old entries with given ids and insert the new rows
+  ids = [(id,) for id in id_row]
+  exec_batch(options,[(PRE_INSERT_STMT,ids),
+                      (INSERT_STMT,list(id_row.values())),
+                      (BUMP_GENERATION_STMT,[()])] + expire_batch(options))
+  vacuum_db(options,VACUUM_PAGES)
+  return list(id_row)
+
+# --- statements for expired entries   --------------------------------------
 
-  # remove old entries with given id
-  exec_sql(options,PRE_INSERT_STMT,args=(id,),commit=True)
+def expire_batch(options):
+  """ return batch of statements deleting expired entries
 
-  # start of uptime-interval (add with enabled==1)
-  args=(sql_args[0],sql_args[1],dtype,value,1,start,id,1)
-  exec_sql(options,INSERT_STMT,args=args,commit=True)
+      Expired entries are DATE-entries older than retention_days. This is
+      done by the write paths (if auto_clean is set), but only once a day.
+  """
+
+  if not getattr(options,'auto_clean',False):
+    return []
+  today = date2day(datetime.date.today())
+  row = open_db(options).execute(
+    "select value from meta where key='expired_day'").fetchone()
+  if row and row[0] == today:
+    return []
+
+  logger.msg("DEBUG","deleting entries older than %d days",
+             options.retention_days)
+  return [(EXPIRE_STMT,[(today-options.retention_days,)]),
+          ("INSERT OR REPLACE INTO meta VALUES ('expired_day',?)",[(today,)])]
+
+# --- reclaim free pages of the database   ----------------------------------
+
+def vacuum_db(options,pages=None):
+  """ reclaim (at most pages, default: all) free pages of the database
+
+      This needs auto_vacuum=INCREMENTAL (schema-version 8), otherwise
+      it is a no-op.
+  """
+
+  db = open_db(options)
+  free = db.execute("PRAGMA freelist_count").fetchone()[0]
+  if not free:
+    return
+  logger.msg("DEBUG","reclaiming %d of %d free pages",
+             min(pages or free,free),free)
+  try:
+    with timings.phase("vacuum"):
+      # executescript() steps to completion (one page per step)
+      db.executescript("PRAGMA incremental_vacuum(%d)" % (pages or free))
+  except sqlite3.Error as e:
+    # not fatal, the pages are reclaimed next time
+    logger.msg("WARN","could not reclaim free pages: %s",e)
+
+# --- next occurrence of a rule   -------------------------------------------
+
+def next_occurrence(rule,day):
+  """ return first epoch-day >= day matching the rule (or None)
 
-  # end of uptime-interval (add with enabled==1)
-  args=(sql_args[0],sql_args[1],dtype,value,0,end,id,1)
-  exec_sql(options,INSERT_STMT,args=args,commit=True)
+      rule is (type,days,every,phase,since,until), see value_rule. This is
+      pure calendar arithmetic, i.e. the cost does not depend on the
+      distance to the next occurrence.
+  """
 
-  # add second interval if necessary (add with enabled==1)
-  if start2:
-    args=(sql_args[0],sql_args[1],dtype,value2,1,start2,id,1)
-    exec_sql(options,INSERT_STMT,args=args,commit=True)
-    args=(sql_args[0],sql_args[1],dtype,value2,0,end2,id,1)
-    exec_sql(options,INSERT_STMT,args=args,commit=True)
+  since,until = rule[4:]
+  day = day if since is None else max(day,since)
+  day = next_day(rule,day)
+  return day if day is None or until is None or day <= until else None
 
-# --- get next day of given dtype   -----------------------------------------
+# --- next day matching the days of a rule   --------------------------------
 
-def next_day(dtype,value):
-  """ value of next day, either a weekday name or a date """
+def next_day(rule,day):
+  """ return first epoch-day >= day matching the days of the rule (or None)
+      (without the bounds of the rule, see next_occurrence) """
 
+  dtype,days,every,phase,_,_ = rule
   if dtype == 'DOW':
-    return value % 7 + 1
+    week,wday = divmod(day+3,7)                 # day 0 was a thursday
+    if week % every == phase:
+      for d in days:
+        if d > wday:
+          return day + d - 1 - wday
+    week += 1 + (phase - week - 1) % every
+    return 7*week - 3 + days[0] - 1
   elif dtype == 'DOM':
-    return value % 31 + 1
+    date = day2date(day)
+    year,month,mday = date.year,date.month,date.day
+    for _ in range(13):
+      last = month_days(year,month)
+      for d in days:
+        d = last if d == 32 else d
+        if mday <= d <= last:
+          return date2day(datetime.date(year,month,d))
+      # no matching day left in this month
+      year,month,mday = (year,month+1,1) if month < 12 else (year+1,1,1)
+    return None
+  elif dtype == 'DATE':
+    return max(day,days[0])
   else:
-    value  = sql2datetime(value,"00:00:00")
-    value += datetime.timedelta(1)
-    return   date2sql(value)
+    return None
+
+# --- number of days of a month   -------------------------------------------
+
+def month_days(year,month):
+  """ return number of days of the month """
+
+  if month == 12:
+    return 31
+  return (datetime.date(year,month+1,1) - datetime.timedelta(1)).day
+
+# --- rule of the value of an entry   ---------------------------------------
+
+def value_rule(dtype,value,since,until):
+  """ return rule (type,days,every,phase,since,until) for next_occurrence
+
+      Invalid values (e.g. added by old versions) never match.
+  """
+
+  if dtype not in ['DOW','DOM']:
+    return dtype,(value,),1,0,since,until
+  try:
+    return (dtype,) + parse_rule(dtype,value) + (since,until)
+  except ValueError as e:
+    logger.msg("WARN","ignoring entry: %s",e)
+    return None,(),1,0,since,until
+
+# --- iterate over days with uptime-requests   ------------------------------
+
+def occurrences(rows,first,last):
+  """ yield (day,events) for all days between first and last with events
+
+      rows are tuples starting with (type,value,since,until,start,end),
+      events are tuples (time,state,row) sorted by time and state (up
+      before down). Days without events are skipped: a heap holds the next
+      occurrence of every distinct rule.
+
+      An interval spanning midnight is split here: the part starting at
+      00:00 belongs to the next day. So the day before first is evaluated
+      too.
+  """
+
+  heapq  = lazy_import('heapq')
+  groups = {}
+  for row in rows:
+    groups.setdefault(row[:4],[]).append(row)
+
+  rules,heap = [],[]
+  for key,group in groups.items():
+    rule = value_rule(*key)
+    day  = next_occurrence(rule,first-1)
+    if day is not None and day <= last:
+      heap.append((day,len(rules)))
+    rules.append((rule,group))
+  heapq.heapify(heap)
+
+  spill_day,spill = None,[]
+  while heap or spill:
+    day    = heap[0][0] if heap and not spill else spill_day
+    events = spill
+    spill  = []
+    while heap and heap[0][0] == day:
+      _,index = heapq.heappop(heap)
+      rule,group = rules[index]
+      for row in group:
+        start,end = row[4],row[5]
+        events.append((start,1,row))
+        if end >= start:
+          events.append((end,0,row))
+        else:
+          events.append((86399,0,row))
+          spill.append((0,1,row))
+          spill.append((end,0,row))
+      day_next = next_occurrence(rule,day+1)
+      if day_next is not None and day_next <= last:
+        heapq.heappush(heap,(day_next,index))
+    spill_day = day + 1
+    if spill_day > last:
+      spill = []
+    if day >= first:
+      events.sort(key=lambda event: (event[0],-event[1]))
+      yield day,events
 
 # --- format value   --------------------------------------------------------
 
-def format_value(vtype,value):
-  """ return formatted value """
+def format_value(vtype,value,since=None,until=None):
+  """ return formatted value (epoch-days of DATE-entries as sql-date,
+      bounds of other entries appended as @since..until) """
 
-  if vtype == 'DOW':
-    return DOW['value']
+  if vtype == 'DATE' and until not in [None,value]:
+    return "%s..%s" % (day2sql(value),day2sql(until))
+  elif vtype == 'DATE':
+    return day2sql(value)
+  elif since is None and until is None:
+    return str(value)
   else:
-    return value
+    return "%s@%s..%s" % (value,"" if since is None else day2sql(since),
+                          "" if until is None else day2sql(until))
 
 # --- print results   -------------------------------------------------------
 
-def print_results(options,rows,state_only=False):
-  """ pretty-print results """
+def print_results(options,rows,state_only=False,fmt=None):
+  """ print results (rows is any iterable, e.g. a cursor)
+
+      Epoch-days and seconds are only converted to text here, row by row.
+      fmt is one of OUTPUT_FORMATS (default: --format).
+  """
+
+  fmt = fmt or options.format
   if state_only:
-    if rows:
-      print(STATE_HEADER)
-      print(STATE_SEP)
-      for row in rows:
-        row = list(row)
-        row[STATE_INDEX_S] = options.STATE_VALUES[row[STATE_INDEX_S]]
-        print(STATE_FORMAT.format(*row))
+    records = ((day2sql(day),secs2time(time),options.STATE_VALUES[state])
+               for (day,time,state) in rows)
+    write_records(fmt,STATE_FIELDS,records,
+                  (STATE_HEADER,STATE_SEP,STATE_FORMAT))
+    return
+
+  if fmt == 'table' and not getattr(options,'DOW',None):
+    options.DOW = dow_map()                       # map isoweekday to string
+  def value(dtype,value):
+    if fmt == 'table' and dtype == 'DOW':
+      return options.DOW.get(str(value),value)
+    return format_value(dtype,value)
+
+  records = ((day2sql(day),cls,label,dtype,value(dtype,val),
+              options.STATE_VALUES[state],secs2time(time),id,enabled)
+             for (day,cls,label,dtype,val,state,time,id,enabled) in rows)
+  write_records(fmt,LIST_FIELDS,records,(LIST_HEADER,LIST_SEP,LIST_FORMAT))
+
+# --- write records   -------------------------------------------------------
+
+def write_records(fmt,fields,records,table):
+  """ write records (tuples in the order of fields) to stdout while
+      iterating them
+
+      table is (header,separator,format) of the table-format, the header
+      is only written for the first record.
+  """
+
+  out = sys.stdout
+  if fmt == 'table':
+    header,sep,line = table
+    for record in records:
+      if header:
+        out.write(header+"\n"+sep+"\n")
+        header = None
+      out.write(line.format(*record)+"\n")
+  elif fmt == 'csv':
+    writer = lazy_import('csv').writer(out,lineterminator="\n")
+    writer.writerow(fields)
+    writer.writerows(records)
   else:
-    if rows:
-      print(LIST_HEADER)
-      print(LIST_SEP)
-      for row in rows:
-        row = list(row)
-        if row[TYPE_INDEX] == 'DOW':
-          row[VALUE_INDEX] = options.DOW[row[VALUE_INDEX]]
-        row[STATE_INDEX] = options.STATE_VALUES[row[STATE_INDEX]]
-        print(LIST_FORMAT.format(*row))
+    json  = lazy_import('json')
+    first = True
+    if fmt == 'json':
+      out.write("[")
+    for record in records:
+      text = json.dumps(dict(zip(fields,record)))
+      if fmt == 'jsonl':
+        out.write(text+"\n")
+      else:
+        out.write(("\n  " if first else ",\n  ")+text)
+      first = False
+    if fmt == 'json':
+      out.write("]\n" if first else "\n]\n")
 
 # --- enable a class   ------------------------------------------------------
 
 def do_enable(options):
-  """ enable all entries of given class in the database """
-  logger.msg("INFO","enabling entries of a class from the database")
+  """ enable classes or entries (ids) in the database """
+  logger.msg("INFO","enabling classes or entries in the database")
 
   if len(options.args) == 0:
     logger.msg("ERROR", "missing argument for enable")
     sys.exit(3)
 
-  ENABLE_STMT = 'UPDATE schedule SET enabled=1 where class=?'
-  exec_sql(options,ENABLE_STMT,args=(options.args[0],),commit=True)
+  exec_batch(options,enable_batch(options,options.args,1)+
+                     [(BUMP_GENERATION_STMT,[()])])
 
 # --- disnable a class   ----------------------------------------------------
 
 def do_disable(options):
-  """ disable all entries of given class in the database """
-  logger.msg("INFO","disabling entries of a class from the database")
+  """ disable classes or entries (ids) in the database """
+  logger.msg("INFO","disabling classes or entries in the database")
 
   if len(options.args) == 0:
     logger.msg("ERROR", "missing argument for disable")
     sys.exit(3)
 
-  DISABLE_STMT = 'UPDATE schedule SET enabled=0 where class=?'
-  exec_sql(options,DISABLE_STMT,args=(options.args[0],),commit=True)
+  exec_batch(options,enable_batch(options,options.args,0)+
+                     [(BUMP_GENERATION_STMT,[()])])
+
+# --- statements for enable/disable   ---------------------------------------
+
+def enable_batch(options,args,enabled):
+  """ return batch of statements to enable/disable classes or ids (args)
+
+      A class is a single row of the classes-table. Entries (and the
+      entries of a class for a single --host) use the flag of their rows.
+  """
+
+  classes,ids = [],[]
+  for arg in args:
+    try:
+      ids.append((enabled,int(arg)))
+    except ValueError:
+      classes.append((enabled,arg))
+
+  batch = []
+  if ids:
+    batch.append(host_statement(options,
+      "UPDATE schedule SET enabled=? where id=?",ids))
+  if classes and options.host:
+    batch.append(host_statement(options,
+      "UPDATE schedule SET enabled=? where class=?",classes))
+  elif classes:
+    batch.append(
+      ("INSERT OR REPLACE INTO classes (enabled,class) VALUES (?,?)",classes))
+  return batch
+
+# --- restrict a statement to a host   --------------------------------------
+
+def host_statement(options,statement,rows):
+  """ return (statement,rows) restricted to --host (if given) """
+
+  if not options.host:
+    return statement,rows
+  return (statement + " and host=?",
+          [tuple(args) + (options.host,) for args in rows])
+
+# --- map arguments of del to a statement   ---------------------------------
+
+def del_statement(args):
+  """ return delete-statement and arguments for id | class [label] """
+
+  if len(args) == 1:
+    try:
+      args = [int(args[0])]
+      logger.msg("INFO", "deleting all entries for id %d",args[0])
+      return "DELETE FROM schedule where id=?",args
+    except:
+      logger.msg("INFO", "deleting all entries for class %s",args[0])
+      return "DELETE FROM schedule where class=?",args
+  else:
+    logger.msg("INFO", "deleting entries for class,label=(%s,%s)",
+               args[0],args[1])
+    return "DELETE FROM schedule where class=? and label=?",args[:2]
 
 # --- delete an uptime-entry from the database   ----------------------------
 
 def do_del(options):
-  """ delete  entries from the database """
+  """ delete  entries from the database
+
+      The arguments are either id | class [label] or '-'. In the latter
+      case, every line of stdin is an id | class [label] specification.
+  """
   logger.msg("INFO","deleting entries from the database")
 
   if len(options.args) == 0:
     logger.msg("ERROR", "missing argument for delete")
-    sys.exit(3)  
-  elif len(options.args) == 1:
-    try:
-      options.args[0] = int(options.args[0])
-      logger.msg("INFO", "deleting all entries for id %d" % options.args[0])
-      statement = "DELETE FROM schedule where id=?"
-    except:
-      logger.msg("INFO", "deleting all entries for class %s" % options.args[0])
-      statement = "DELETE FROM schedule where class=?"
+    sys.exit(3)
+  elif options.args[0] == '-':
+    shlex = lazy_import('shlex')
+    specs = []
+    for line in sys.stdin:
+      if len(line) < 2 or line[0] == '#':
+        # ignore empty lines or comments
+        continue
+      specs.append(shlex.split(line)[:2])
   else:
-    logger.msg("INFO", "deleting entries for class,label=(%s,%s)" %
-               (options.args[0],options.args[1]))
-    statement = "DELETE FROM schedule where class=? and label=?"
-
-  exec_sql(options,statement,args=options.args,commit=True)
+    specs = [options.args]
+  del_entries(options,specs)
 
   if options.auto_set:
     logger.msg("INFO","del: automatically updating next halt and boot")
-    options.args = ['halt']
-    do_set(options)
-    options.args = ['boot']
+    options.args = ['both']
     do_set(options)
 
+# --- delete entries   ------------------------------------------------------
+
+def del_entries(options,specs):
+  """ delete entries for a list of specifications id | class [label] """
+
+  # group arguments by statement, so we can use executemany
+  statements = {}
+  for spec in specs:
+    statement,args = del_statement(spec)
+    statements.setdefault(statement,[]).append(args)
+  if not options.host and "DELETE FROM schedule where class=?" in statements:
+    # a deleted class is enabled again when new entries are added
+    statements["DELETE FROM classes where class=?"] = (
+      statements["DELETE FROM schedule where class=?"])
+  exec_batch(options,[host_statement(options,statement,rows)
+                      for statement,rows in statements.items()] +
+                     [(BUMP_GENERATION_STMT,[()])] + expire_batch(options))
+  vacuum_db(options,VACUUM_PAGES)
+
 # --- clean old entries in the database   -----------------------------------
 
 def do_clean(options):
-  """ clean old entries in the database """
+  """ clean old entries in the database and reclaim all free pages """
 
-  date_now = datetime.date.today()
-  open_db(options)
-  logger.msg("INFO", "deleting entries in database older than %s" %
-             datetime.datetime.strftime(date_now,"%Y-%m-%d"))
-  statement = "DELETE FROM schedule where value < ? and type = 'DATE'"
-  exec_sql(options,statement,args=(date_now,),commit=True)
+  date_now = datetime.date.today() - datetime.timedelta(options.retention_days)
+  logger.msg("INFO", "deleting entries in database older than %s",
+             date2sql(date_now))
+  exec_batch(options,[(EXPIRE_STMT,[(date2day(date_now),)]),
+                      (BUMP_GENERATION_STMT,[()])])
+  vacuum_db(options)
 
 # --- list entries of the database   ----------------------------------------
 
@@ -424,35 +1444,502 @@ def do_raw(options):
   """ list entries of the database """
   logger.msg("INFO","listing entries of the database")
 
-  open_db(options)
-  cursor = options.db.cursor()
-  cursor.execute("select * from schedule")
-  rows = cursor.fetchall()
-  close_db(options)
+  cursor = open_db(options).cursor()
+  cursor.execute(SCHEDULE_SELECT)
+
+  # print results (iterating the cursor)
+  table = options.format == 'table'
+  if table:
+    print(RAW_HEADER)
+    print(RAW_SEP)
+  records = ((cls,label,dtype,format_value(dtype,value,since,until),
+              secs2time(start),secs2time(end),id,enabled,
+              (host or '*') if table else host)
+             for (cls,label,dtype,value,since,until,start,end,id,enabled,
+                  host) in cursor)
+  write_records(options.format,RAW_FIELDS,records,(None,None,RAW_FORMAT))
+
+# --- import entries   ------------------------------------------------------
+
+def do_import(options):
+  """ import entries in jsonl- or csv-format from a file or stdin
+
+      The entries are streamed and inserted in batches of IMPORT_BATCH
+      entries within a single transaction. Existing entries with the same
+      id are replaced.
+  """
 
-  # print results
-  print(RAW_HEADER)
-  print(RAW_SEP)
-  for row in rows:
-    print(RAW_FORMAT.format(*row))
+  fmt,fname = transfer_args(options)
+  if not fmt:
+    return
+  logger.msg("INFO","import: reading %s-entries from %s",fmt,fname)
 
-# --- list uptimes for a given period   -------------------------------------
+  count = 0
+  db = open_db(options)
+  try:
+    with transfer_file(fname,"r") as f, db:
+      cursor = begin_write(options)
+      for batch in batched(read_entries(f,fmt,options.host),IMPORT_BATCH):
+        id_row = dict(batch)              # duplicate ids are only added once
+        cursor.executemany(PRE_INSERT_STMT,[(id,) for id in id_row])
+        cursor.executemany(INSERT_STMT,list(id_row.values()))
+        count += len(batch)
+      for statement,rows in expire_batch(options):
+        cursor.executemany(statement,rows)
+      cursor.execute(BUMP_GENERATION_STMT)
+  except (OSError,ValueError,sqlite3.Error) as e:
+    logger.msg("ERROR","import: %s (nothing imported)",e)
+    sys.exit(3)
+  options.timeline = None
+  vacuum_db(options,VACUUM_PAGES)
+  logger.msg("INFO","import: %d entries imported",count)
 
-def do_list(options):
-  """ list uptimes """
+  if options.auto_set:
+    logger.msg("INFO","import: automatically updating next halt and boot")
+    options.args = ['both']
+    do_set(options)
 
-  list_type = options.args[0] if len(options.args) else 'today'
-  logger.msg("INFO","listing uptimes for %s" % list_type)
+# --- export entries   ------------------------------------------------------
 
-  if list_type == 'today':
+def do_export(options):
+  """ export entries in jsonl- or csv-format to a file or stdout
+
+      The entries are read with a single query and written while
+      iterating the cursor.
+  """
+
+  fmt,fname = transfer_args(options)
+  if not fmt:
+    return
+  logger.msg("INFO","export: writing %s-entries to %s",fmt,fname)
+
+  cursor = open_db(options).cursor()
+  cursor.execute(SCHEDULE_SELECT + " order by s.class,label,id")
+  records = (row2record(row) for row in cursor)
+
+  count = 0
+  with transfer_file(fname,"w") as f:
+    if fmt == 'jsonl':
+      json = lazy_import('json')
+      for record in records:
+        f.write(json.dumps(record)+"\n")
+        count += 1
+    else:
+      writer = lazy_import('csv').DictWriter(f,TRANSFER_FIELDS,
+                                             lineterminator="\n")
+      writer.writeheader()
+      for record in records:
+        writer.writerow(record)
+        count += 1
+  logger.msg("INFO","export: %d entries exported",count)
+
+# --- arguments of import/export   ------------------------------------------
+
+def transfer_args(options):
+  """ return (format,filename) of import/export ('-' is stdin/stdout) """
+
+  if not len(options.args) or options.args[0] not in TRANSFER_FORMATS:
+    print("the %s command needs a format (%s) and an optional file" %
+          (options.cmd,"|".join(TRANSFER_FORMATS)))
+    return None,None
+  return options.args[0],options.args[1] if len(options.args) > 1 else '-'
+
+# --- open file for import/export   -----------------------------------------
+
+@contextlib.contextmanager
+def transfer_file(fname,mode):
+  """ open file (or use stdin/stdout for '-') """
+
+  if fname == '-':
+    yield sys.stdin if mode == "r" else sys.stdout
+  else:
+    with open(fname,mode,newline='') as f:
+      yield f
+
+# --- read entries   --------------------------------------------------------
+
+def read_entries(f,fmt,host=None):
+  """ yield (id,row) for all entries of the file (see entry2row)
+
+      host is used for records without a host.
+  """
+
+  if fmt == 'jsonl':
+    json = lazy_import('json')
+    records = ((lineno,line) for lineno,line in enumerate(f,1) if line.strip())
+  else:
+    reader  = lazy_import('csv').DictReader(f)
+    records = ((reader.line_num,record) for record in reader)
+
+  for lineno,record in records:
+    try:
+      if fmt == 'jsonl':
+        record = json.loads(record)
+      yield record2row(record,host)
+    except (KeyError,ValueError,IndexError,TypeError,AttributeError) as e:
+      raise ValueError("invalid entry in line %d: %r" % (lineno,e))
+
+# --- batches of an iterable   ----------------------------------------------
+
+def batched(iterable,size):
+  """ yield lists with at most size items of the iterable """
+
+  batch = []
+  for item in iterable:
+    batch.append(item)
+    if len(batch) == size:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+# --- convert an imported record to a row   ---------------------------------
+
+def record2row(record,host=None):
+  """ convert a record (dict of TRANSFER_FIELDS) to the id and the row """
+
+  sql_args = [str(record[field]) for field in TRANSFER_FIELDS[:5]]
+  enabled,id,record_host = [record.get(field) for field in TRANSFER_FIELDS[5:]]
+  return entry2row(sql_args,
+                   id=None if id in [None,''] else int(id),
+                   enabled=1 if enabled in [None,''] else int(enabled),
+                   host=record_host or host)
+
+# --- convert a value to text   --------------------------------------------
+
+def value2text(dtype,value,since,until):
+  """ return value in the format of add (see parse_value) """
+
+  def date(day):
+    return "" if day is None else day2date(day).strftime("%d.%m.%Y")
+
+  if dtype == 'DATE':
+    return date(value) + ("-" + date(until) if until != value else "")
+  elif since is None and until is None:
+    return str(value)
+  else:
+    return "%s@%s-%s" % (value,date(since),date(until))
+
+# --- convert a row to an exported record   ---------------------------------
+
+def row2record(row):
+  """ convert the row of an entry back to a record """
+
+  (cls,label,dtype,value,since,until,start,end,id,enabled,host) = row
+  value = value2text(dtype,value,since,until)
+  times = [secs2time(t)[:5] if t % 60 == 0 else secs2time(t)
+           for t in [start,end]]
+  return dict(zip(TRANSFER_FIELDS,
+                  [cls,label,dtype,str(value),"-".join(times),enabled,id,
+                   host]))
+
+# --- import events of an iCalendar-file   ----------------------------------
+
+def do_import_ics(options):
+  """ import the events of an iCalendar-file into a class
+
+      The class belongs to the calendar: entries of the class (and --host)
+      which are not in the file anymore are deleted. Since the id of an
+      entry is the hash of its content, only new or changed events are
+      written. The import is skipped if the modification-time and size
+      (or the sha256 of the content) of the file did not change, unless
+      --force is given. With --dry-run the differences are only printed.
+  """
+
+  if len(options.args) not in [1,2]:
+    print("the import-ics command needs a file and an optional class")
+    return
+  fname = os.path.abspath(options.args[0])
+  cls   = (options.args[1] if len(options.args) > 1 else
+           os.path.splitext(os.path.basename(fname))[0])
+  key   = "ics:%s|%s|%s" % (fname,cls,options.host or '')
+  try:
+    stat = os.stat(fname)
+  except OSError as e:
+    logger.msg("ERROR","import-ics: %s",e)
+    sys.exit(3)
+
+  # skip unchanged files
+  db  = open_db(options)
+  row = db.execute("select value from meta where key=?",(key,)).fetchone()
+  signature = "%d|%d" % (stat.st_mtime_ns,stat.st_size)
+  old_signature,_,old_digest = (row[0] if row else "").rpartition('|')
+  if signature == old_signature and not options.force:
+    logger.msg("INFO","import-ics: %s is unchanged",fname)
+    return
+
+  logger.msg("INFO","import-ics: reading events of %s (class %s)",fname,cls)
+  digest = lazy_import('hashlib').sha256()
+  try:
+    with open(fname,"rb") as f:
+      id_row = dict(entry2row(sql_args,host=options.host)
+                    for sql_args in ics_entries(ics_lines(f,digest),cls))
+  except (OSError,ValueError) as e:
+    logger.msg("ERROR","import-ics: %s (nothing imported)",e)
+    sys.exit(3)
+  batch = [("INSERT OR REPLACE INTO meta VALUES (?,?)",
+            [(key,"%s|%s" % (signature,digest.hexdigest()))])]
+  if digest.hexdigest() == old_digest and not options.force:
+    logger.msg("INFO","import-ics: content of %s is unchanged",fname)
+    if not options.dry_run:
+      exec_batch(options,batch)
+    return
+
+  # only write the difference to the entries of the class
+  if (sync_entries(options,"import-ics",id_row," and class=?",[cls],batch)
+      and options.auto_set):
+    logger.msg("INFO","import-ics: automatically updating next halt and boot")
+    options.args = ['both']
+    do_set(options)
+
+# --- unfolded lines of an iCalendar-file   ---------------------------------
+
+def ics_lines(f,digest):
+  """ yield unfolded content-lines of a (binary) file, update the digest """
+
+  line = None
+  for raw in f:
+    digest.update(raw)
+    text = raw.decode('utf-8').rstrip("\r\n")
+    if text[:1] in [' ','\t'] and line is not None:
+      line += text[1:]
+      continue
+    if line:
+      yield line
+    line = text
+  if line:
+    yield line
+
+# --- events of an iCalendar-file   -----------------------------------------
+
+def ics_events(lines):
+  """ yield the properties of every VEVENT as dict name -> (params,value)
+
+      Components within an event (e.g. VALARM) are skipped.
+  """
+
+  event,nested = None,0
+  for line in lines:
+    name,params,value = ics_property(line)
+    if name == 'BEGIN' and value.upper() == 'VEVENT':
+      event,nested = {},0
+    elif event is None:
+      continue
+    elif name == 'BEGIN':
+      nested += 1
+    elif name == 'END' and nested:
+      nested -= 1
+    elif name == 'END':
+      yield event
+      event = None
+    elif not nested:
+      event.setdefault(name,(params,value))
+
+# --- split a content-line   ------------------------------------------------
+
+def ics_property(line):
+  """ return (name,params,value) of a content-line (params is a dict) """
+
+  quoted = False
+  for i,c in enumerate(line):
+    if c == '"':
+      quoted = not quoted
+    elif c == ':' and not quoted:
+      break
+  else:
+    raise ValueError("invalid content-line: %s" % line)
+  name,*params = line[:i].split(';')
+  params = dict(param.partition('=')[::2] for param in params)
+  params = {k.upper(): v.strip('"') for k,v in params.items()}
+  return name.upper(),params,line[i+1:]
+
+# --- convert events to entries   -------------------------------------------
+
+def ics_entries(lines,cls):
+  """ yield arguments of add (see entry2row) for the events
+
+      Events which cannot be converted are skipped with a warning.
+  """
+
+  for event in ics_events(lines):
+    if event.get('STATUS',({},''))[1].upper() == 'CANCELLED':
+      continue
+    try:
+      for sql_args in event2entries(event,cls):
+        yield sql_args
+    except (KeyError,ValueError,IndexError) as e:
+      logger.msg("WARN","import-ics: ignoring event %s: %s",
+                 event.get('UID',({},'?'))[1],e)
+
+# --- convert an event to entries   -----------------------------------------
+
+def event2entries(event,cls):
+  """ return list of arguments of add for an event
+
+      Single events are DATE-entries (events longer than a day need up to
+      three entries), recurring events are DOW- or DOM-rules (see
+      rrule2value). EXDATE and RDATE are not supported.
+  """
+
+  label = (ics_text(event.get('SUMMARY',({},''))[1]) or
+           event.get('UID',({},'event'))[1])
+  start,all_day = ics_datetime(*event['DTSTART'])
+  if 'DTEND' in event:
+    end,_ = ics_datetime(*event['DTEND'])
+  elif 'DURATION' in event:
+    end = start + ics_duration(event['DURATION'][1])
+  else:
+    end = start + datetime.timedelta(days=1 if all_day else 0)
+  if end < start:
+    raise ValueError("event ends before it starts")
+
+  def date(day):
+    return day2date(day).strftime("%d.%m.%Y")
+
+  if all_day:
+    # DTEND of all-day events is exclusive
+    first,last = date2day(start),max(date2day(end)-1,date2day(start))
+    interval   = "00:00-23:59:59"
+  else:
+    first,last = date2day(start.date()),date2day(end.date())
+    interval   = "%s-%s" % (start.strftime("%H:%M:%S"),
+                            "23:59:59" if last > first and
+                            end.time() == datetime.time(0) else
+                            end.strftime("%H:%M:%S"))
+  long_event = (last > first if all_day else
+                end - start >= datetime.timedelta(days=1))
+
+  if 'RRULE' in event:
+    if long_event:
+      raise ValueError("recurring events longer than a day are not supported")
+    dtype,value = rrule2value(event['RRULE'][1],first)
+    return [[cls,label,dtype,value,interval]]
+  elif all_day:
+    value = date(first) + ("-" + date(last) if last > first else "")
+    return [[cls,label,'DATE',value,interval]]
+  elif not long_event:
+    return [[cls,label,'DATE',date(first),interval]]
+
+  # split events longer than a day: first day, days between, last day
+  entries = [[cls,label,'DATE',date(first),
+              "%s-23:59:59" % start.strftime("%H:%M:%S")]]
+  if last-1 > first:
+    entries.append([cls,label,'DATE',date(first+1) + "-" + date(last-1),
+                    "00:00-23:59:59"])
+  if end.time() != datetime.time(0):
+    entries.append([cls,label,'DATE',date(last),
+                    "00:00-%s" % end.strftime("%H:%M:%S")])
+  return entries
+
+# --- convert an RRULE to a value   -----------------------------------------
+
+def rrule2value(rrule,since):
+  """ return (type,value) for an RRULE starting at epoch-day since
+
+      Supported are weekly rules (with BYDAY and INTERVAL), daily rules
+      (every day or BYDAY) and monthly rules with BYMONTHDAY (-1 is the
+      last day). UNTIL and COUNT limit the rule (see parse_value).
+  """
+
+  parts = dict(part.partition('=')[::2] for part in rrule.upper().split(';')
+               if part)
+  freq,every = parts.get('FREQ'),int(parts.get('INTERVAL',1))
+  unsupported = [part for part in parts if part not in ICS_RRULE]
+  if unsupported:
+    raise ValueError("unsupported RRULE-parts: %s" % ",".join(unsupported))
+
+  byday = [day for day in parts.get('BYDAY','').split(',') if day]
+  if freq in ['WEEKLY','DAILY'] and (freq == 'WEEKLY' or every == 1):
+    if byday:
+      days = [ICS_DAYS[day] for day in byday]  # no ordinals for weekly rules
+    elif freq == 'WEEKLY':
+      days = [day_value('DOW',0,since)]
+    else:
+      days = list(range(1,8))
+    every = every if freq == 'WEEKLY' else 1
+    dtype,value = 'DOW',format_rule('DOW',tuple(sorted(set(days))),every,
+                                    ((since+3) // 7) % every)
+  elif freq == 'MONTHLY' and every == 1 and not byday:
+    days = [int(day) for day in parts.get('BYMONTHDAY','').split(',') if day]
+    days = [32 if day == -1 else day
+            for day in days or [day_value('DOM',0,since)]]
+    if min(days) < 1 or max(days) > 32:
+      raise ValueError("unsupported BYMONTHDAY: %s" % parts['BYMONTHDAY'])
+    dtype,value = 'DOM',format_rule('DOM',tuple(sorted(set(days))),1,0)
+  else:
+    raise ValueError("unsupported RRULE: %s" % rrule)
+
+  until = None
+  if 'UNTIL' in parts:
+    until,all_day = ics_datetime({},parts['UNTIL'])
+    until = date2day(until if all_day else until.date())
+  elif 'COUNT' in parts:
+    # last day of COUNT occurrences
+    rule = value_rule(dtype,value,since,None)
+    day  = since
+    for _ in range(int(parts['COUNT'])):
+      until = next_occurrence(rule,day)
+      day   = until + 1
+  return dtype,value2text(dtype,value,since,until)
+
+# --- convert a date or date-time   -----------------------------------------
+
+def ics_datetime(params,value):
+  """ return (date,True) or (local datetime,False) of a DATE or DATE-TIME """
+
+  if params.get('VALUE') == 'DATE' or len(value) == 8:
+    return datetime.datetime.strptime(value,"%Y%m%d").date(),True
+
+  dt = datetime.datetime.strptime(value[:15],"%Y%m%dT%H%M%S")
+  if value.endswith('Z'):
+    dt = dt.replace(tzinfo=datetime.timezone.utc)
+  elif 'TZID' in params:
+    try:
+      dt = dt.replace(tzinfo=lazy_import('zoneinfo').ZoneInfo(params['TZID']))
+    except (ImportError,KeyError,ValueError) as e:
+      logger.msg("DEBUG","unknown TZID %s (using local time): %s",
+                 params['TZID'],e)
+  if dt.tzinfo:
+    dt = dt.astimezone().replace(tzinfo=None)
+  return dt,False
+
+# --- convert a duration   --------------------------------------------------
+
+def ics_duration(value):
+  """ return timedelta of a DURATION like P1DT2H30M (or PT15M, P1W) """
+
+  re = lazy_import('re')
+  match = re.fullmatch(r"([+-]?)P(?:(\d+)W)?(?:(\d+)D)?"
+                       r"(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?",value)
+  if not match:
+    raise ValueError("invalid duration: %s" % value)
+  sign = -1 if match.group(1) == '-' else 1
+  weeks,days,hours,minutes,seconds = [int(g or 0) for g in match.groups()[1:]]
+  return sign*datetime.timedelta(weeks=weeks,days=days,hours=hours,
+                                 minutes=minutes,seconds=seconds)
+
+# --- unescape text   -------------------------------------------------------
+
+def ics_text(value):
+  """ return unescaped TEXT-value (newlines are replaced by blanks) """
+
+  re = lazy_import('re')
+  return re.sub(r"\\([\\;,nN])",
+                lambda m: {'n': ' ','N': ' '}.get(m.group(1),m.group(1)),
+                value).strip()
+
+# --- list uptimes for a given period   -------------------------------------
+
+def do_list(options):
+  """ list uptimes """
+
+  list_type = options.args[0] if len(options.args) else 'today'
+  logger.msg("INFO","listing uptimes for %s",list_type)
+
+  if list_type == 'today':
     rows = fetch_uptimes(options,datetime.date.today())
   elif list_type == 'week':
-    delta = datetime.timedelta(1)
-    day = datetime.date.today()
-    rows = []
-    for _ in range(7):
-      rows.extend(fetch_uptimes(options,day))
-      day = day + delta
+    rows = fetch_uptimes(options,datetime.date.today(),7)
   else:
     # list_type contains a date
     length = len(list_type)
@@ -463,33 +1950,69 @@ def do_list(options):
       list_type = list_type + "20" + parts[2]
     else:
       list_type = list_type + parts[2]
+    init_locale()
     rows = fetch_uptimes(options,datetime.datetime.strptime(list_type,"%x").date())
 
   # print results
   print_results(options,rows)
 
-# --- query uptimes for a given date   ---------------------------------------
+# --- query uptimes for a range of dates   ----------------------------------
 
-def fetch_uptimes(options,date):
-  """ fetch uptimes for given date """
-  logger.msg("DEBUG","fetching uptimes for %r" % date)
+def fetch_uptimes(options,date,days=1):
+  """ fetch uptimes for given number of days starting at date
+
+      This is a single query for the whole range, the entries are expanded
+      to the days of the range (see occurrences). The rows
+      (day,class,label,type,value,state,time,id,enabled) are returned as an
+      iterator (ordered by date, time and state).
+  """
+  logger.msg("DEBUG","fetching uptimes for %r (%d days)",date,days)
 
   # get entries in DB
-  open_db(options)
-  cursor = options.db.cursor()
-  cursor.execute("""
-     select '%s',* from schedule where
-      enabled = 1 AND (
-      type = 'DOW'  AND value=?  OR
-      type = 'DOM'  AND value=?  OR
-      type = 'DATE' AND value=? )
-         order by time, state desc""" % date2sql(date),
-                 (dow(date),dom(date),date2sql(date)))
-  rows = cursor.fetchall()
-  close_db(options)
+  first,last = date2day(date),date2day(date)+days-1
+  range_days = range(first-1,last+1)            # including the day before
+  where = FETCH_UPTIMES_WHERE.format(
+    ",".join(str(d) for d in set(day_value('DOW',0,day) for day in range_days)),
+    ",".join(str(d) for d in set(day_value('DOM',0,day) for day in range_days)))
+  with timings.phase("query uptimes"):
+    rows = open_db(options).execute(
+      AGGREGATE_STMT.format(FETCH_UPTIMES_COLS,where),
+      (eval_host(options),first,last)).fetchall()
+  uptimes = ((day,cls,label,dtype,day_value(dtype,value,day),state,time,id,
+              enabled)
+             for day,events in occurrences(rows,first,last)
+             for (time,state,(dtype,value,_,_,_,_,cls,label,id,enabled))
+             in events)
+  if not logger.is_level("TRACE"):
+    return uptimes
+  else:
+    return trace_rows(uptimes)
+
+# --- value of an entry for a single day   ----------------------------------
+
+def day_value(dtype,value,day):
+  """ return value of a single day (weekday, day of month or epoch-day)
+
+      Rules (text) are returned unchanged.
+  """
+
+  if not isinstance(value,int):
+    return value
+  elif dtype == 'DOW':
+    return (day+3) % 7 + 1
+  elif dtype == 'DOM':
+    return day2date(day).day
+  else:
+    return day
+
+# --- trace rows of a query   -----------------------------------------------
+
+def trace_rows(rows):
+  """ pass-through rows and trace every row """
+
   for row in rows:
-    logger.msg("TRACE","%r" % (row,))
-  return rows
+    logger.msg("TRACE","%r",row)
+    yield row
 
 # --- get next boot or halt time   ------------------------------------------
 
@@ -497,208 +2020,1298 @@ def do_get(options):
   """ get next boot or halt time """
 
   get_type = options.args[0] if len(options.args) else 'halt'
-  logger.msg("INFO","calculating next %s" % get_type)
-  today  = date2sql(datetime.date.today())
-  dt_now = datetime.datetime.now()
-  now    = dt_now.time().strftime("%H:%M:%S")
-  logger.msg("TRACE","now: %s" % now)
+  logger.msg("INFO","calculating next %s",get_type)
 
   states = consolidate_uptimes(options,raw=get_type=='raw')
   if get_type in ['raw','all']:
     print_results(options,states,True)
-    return ""
+    return
+
+  event = next_event(options,states,get_type)
+  if event:
+    print(event[0])
+
+# --- find next boot or halt time   -----------------------------------------
+
+def next_event(options,states,get_type):
+  """ find next boot or halt time in the consolidated state-changes
+
+      Returns (time-string,datetime) including the grace-period or None.
+  """
+
+  dt_now     = datetime.datetime.now()
+  today,now  = date2day(dt_now.date()),secs_of_day(dt_now)
+  ts_now     = 86400*today + now + dt_now.microsecond/1e6
+  logger.msg("TRACE","now: %s",secs2time(now))
 
   for (day,time,state) in states:
     if day > today:
-      now = "00:00:00"
+      now = 0
     if get_type == "boot" and state == 0:
       continue
     elif get_type == "halt" and state == 1:
       continue
     elif now < time:
-      # convert to datetime and add grace-periods
-      dt_time = datetime.datetime.strptime("%s %s" % (day,time),"%Y-%m-%d %H:%M:%S")
+      # add grace-periods
+      ts_time = 86400*day + time
       if get_type == "boot":
-        delta = datetime.timedelta(minutes=-options.grace_boot)
-        if dt_time + delta < dt_now:
+        ts_time -= 60*options.grace_boot
+        if ts_time < ts_now:
           # boot time is in the past or within the next grace_boot minutes
           # so we ignore this event
-          logger.msg("TRACE","ignoring %s (within %d minutes of now)" %
-                     (dt_time,options.grace_boot))
+          logger.msg("TRACE","ignoring %s %s (within %d minutes of now)",
+                     day2sql(day),secs2time(time),options.grace_boot)
           continue
       elif get_type == "halt":
-        delta = datetime.timedelta(minutes=options.grace_halt)
-      dt_time += delta
-      str_time = datetime.datetime.strftime(dt_time,"%Y-%m-%d %H:%M:%S")
-      if options.cmd == 'get':
-        print(str_time)
-      else:
-        return str_time,dt_time
-      return
+        ts_time += 60*options.grace_halt
+      # convert to datetime only for the result
+      dt_time = datetime.datetime.combine(day2date(ts_time // 86400),
+                                          datetime.time())
+      dt_time += datetime.timedelta(seconds=ts_time % 86400)
+      return datetime.datetime.strftime(dt_time,"%Y-%m-%d %H:%M:%S"),dt_time
 
-  return ""
+  return None
 
 # --- set next halt|boot time   ---------------------------------------------
 
 def do_set(options):
-  """ set next boot or halt time
+  """ set next boot or halt time (or both)
       This method will call um_set_boot/um_set_halt and pass four values:
         - action-time as %Y-%m-%d %H:%M:%S
         - action-time as %s (unix-timestamp aka seconds since epoch)
         - time in seconds until action-time
         - path to database
+      The hooks are only called if the action-time changed (see run_hook).
   """
 
-  if len(options.args) != 1:
-    print("the set command needs a single option halt|boot")
+  if len(options.args) != 1 or options.args[0] not in ['halt','boot','both']:
+    print("the set command needs a single option halt|boot|both")
     return
 
   set_type = options.args[0]
-  if set_type not in ['halt','boot']:
-    print("the set command needs a single option halt|boot")
+  set_types = ['halt','boot'] if set_type == 'both' else [set_type]
+
+  # consolidate once, even if we need both halt and boot
+  states = consolidate_uptimes(options)
+  for set_type in set_types:
+    event = next_event(options,states,set_type)
+    if not event:
+      logger.msg("WARN","no next %s found",set_type)
+      continue
+    run_hook(options,set_type,*event)
+
+# --- run hook um_set_halt|um_set_boot   ------------------------------------
+
+def run_hook(options,set_type,t_action,dt_action):
+  """ run um_set_halt|um_set_boot if the action-time changed
+
+      The last action-time applied (together with the boot-id, since timers
+      and alarms don't survive a reboot) is saved in the meta-table. The
+      hook is skipped if nothing changed, unless --force is given.
+  """
+
+  key     = "applied_%s" % set_type
+  applied = "%s|%s" % (get_boot_id(),t_action)
+  cursor  = open_db(options).cursor()
+  cursor.execute("select value from meta where key=?",(key,))
+  row = cursor.fetchone()
+  if row and row[0] == applied and not options.force:
+    logger.msg("INFO","next %s at %s already set",set_type,t_action)
     return
 
-  t_action,dt_action = do_get(options)
-  dt_now    = datetime.datetime.now()
-  delta     = dt_action - dt_now
-  logger.msg("INFO","setting next %s at %s" % (set_type,t_action))
+  subprocess = lazy_import('subprocess')
+  delta = dt_action - datetime.datetime.now()
+  logger.msg("INFO","setting next %s at %s",set_type,t_action)
   hook = os.path.join(options.pgmdir,"um_set_%s" % set_type)
-  os.system("%s \"%s\" %d %d \"%s\" &" %
-            (hook,t_action,dt_action.timestamp(),
-             delta.total_seconds(),options.db_name))
+  try:
+    with timings.phase("hook %s" % set_type):
+      proc = subprocess.run([hook,t_action,"%d" % dt_action.timestamp(),
+                             "%d" % delta.total_seconds(),options.db_name],
+                            stdout=subprocess.PIPE,stderr=subprocess.STDOUT,
+                            universal_newlines=True,timeout=HOOK_TIMEOUT)
+  except subprocess.TimeoutExpired:
+    logger.msg("ERROR","%s: timeout after %d seconds",hook,HOOK_TIMEOUT)
+    return
+  except OSError as e:
+    logger.msg("ERROR","%s: %s",hook,e)
+    return
+
+  sys.stdout.write(proc.stdout)
+  if proc.returncode:
+    logger.msg("ERROR","%s: exit-code %d",hook,proc.returncode)
+  else:
+    exec_sql(options,"INSERT OR REPLACE INTO meta VALUES (?,?)",
+             args=(key,applied),commit=True)
+
+# --- query boot-id   -------------------------------------------------------
+
+def get_boot_id():
+  """ return boot-id of the running system (empty if not available) """
+
+  try:
+    with open(BOOT_ID_FILE,"r") as f:
+      return f.read().strip()
+  except OSError:
+    return ""
 
 # --- consolidate uptimes   --------------------------------------------------
 
-def consolidate_uptimes(options,raw=False):
-  """ consolidate uptime """
+def consolidate_uptimes(options,raw=False,aggregated=None):
+  """ consolidate uptime (aggregated state-changes default to the cache) """
+
+  dt_now    = datetime.datetime.now()
+  today,now = date2day(dt_now.date()),secs_of_day(dt_now)
+
+  # the aggregated state-changes are cached. The only part depending on the
+  # current time is the first up-event of today while we are already up
+  result     = []
+  first_boot = True
+  if aggregated is None:
+    aggregated = cached_uptimes(options,today)
+  for (day,time,state,candidate) in aggregated:
+    if not candidate:
+      result.append((day,time,state))
+    elif first_boot and time > now:
+      logger.msg("TRACE","adding time: %s, state: %d",time,state)
+      result.append((day,time,state))
+      first_boot = False
+
+  # for debug-purposes, print list
+  if logger.is_level("DEBUG"):
+    logger.msg("DEBUG","state-changes before consolidation: %d",len(result))
+    print_results(options,result,True,'table')
 
-  # we might have to look into the future, so we iterate starting from today
-  delta = datetime.timedelta(1)
-  day   = datetime.date.today()
-  now   = datetime.datetime.now().strftime("%H:%M:%S")
+  # finish here, if raw values were requested
+  if raw:
+    return result
+
+  # now we consolidate the periods
+  with timings.phase("consolidation"):
+    result = merge_uptimes(result,today,now,options.min_downtime)
+
+  # for debug-purposes, print list
+  if logger.is_level("DEBUG"):
+    logger.msg("DEBUG","state-changes after consolidation: %d",len(result))
+    print_results(options,result,True,'table')
+
+  return result
+
+# --- aggregate uptime-requests   ------------------------------------------
+
+def aggregate_uptimes(options,today):
+  """ aggregate uptime-requests of the host to state-changes """
+
+  # all enabled rows are loaded once, the days with uptime-requests are
+  # calculated from the values (see occurrences)
+  with timings.phase("query schedule"):
+    rows = open_db(options).execute(AGGREGATE_STMT.format(AGGREGATE_COLS,""),
+                                    (eval_host(options),today)).fetchall()
+  return aggregate_rows(rows,today,options.time_horizon,
+                        options.min_downtime)
+
+# --- aggregate rows of the schedule   --------------------------------------
+
+def aggregate_rows(rows,today,time_horizon,min_downtime):
+  """ aggregate uptime-requests (rows of type,value,since,until,start,end) to
+      state-changes
+
+      Returns a list of integer tuples (day,time,state,candidate) with
+      epoch-days and seconds of day. Candidates are up-events
+      of today while the state is already up: consolidate_uptimes() uses the
+      first candidate after the current time.
+
+      State-changes are calculated for TIME_HORIZON days. Beyond that, we
+      only continue (up to time_horizon days) until we have found a halt
+      and a boot after today which survive consolidation: a boot only
+      counts if it is at least min_downtime minutes after the previous halt
+      and not at 00:00 (the continuation of an interval spanning midnight),
+      and the last halt must be final, i.e. not at 00:00 and the next event
+      is at least min_downtime minutes later.
+  """
 
   result = []
-  state = 0
-  logger.msg("TRACE","state: %d" % state)
-
-  # we first aggregate all uptime periods
-  for i in range(TIME_HORIZON):
-    logger.msg("TRACE","examining day %s" % date2sql(day))
-    first_boot = i == 0
-    rows = fetch_uptimes(options,day)
-    for row in rows:
+  found  = set()
+  state  = 0
+  halt   = None                    # last halt in seconds since the epoch
+  logger.msg("TRACE","state: %d",state)
+
+  last = today + max(time_horizon,TIME_HORIZON) - 1
+  for day,events in occurrences(rows,today,last):
+    if (day >= today + TIME_HORIZON and len(found) == 2 and state == 0 and
+        halt % 86400 and 86400*day + events[0][0] - halt >= 60*min_downtime):
+      break
+    for (time,row_state,_) in events:
       # aggregate uptime-requests
-      if row[STATE_INDEX] == 1:
+      if row_state == 1:
         state += 1
       else:
         state = max(state-1,0)
-      logger.msg("TRACE","time: %s, state: %d" % (row[I_TIME],state))
+      logger.msg("TRACE","time: %s, state: %d",time,state)
 
       # next halt is when we reach zero
       if (state == 0):
-        logger.msg("TRACE","adding time: %s, state: %d" % (row[I_TIME],state))
-        result.append((date2sql(day),row[I_TIME],state))
+        logger.msg("TRACE","adding time: %s, state: %d",time,state)
+        result.append((day,time,state,0))
+        halt = 86400*day + time
+        if day > today:
+          found.add(state)
       # next boot is after a transition from 0 to 1
-      elif (state == 1 and row[STATE_INDEX] == 1):
-        logger.msg("TRACE","adding time: %s, state: %d" % (row[I_TIME],state))
-        result.append((date2sql(day),row[I_TIME],state))
-      elif (state > 1 and row[STATE_INDEX] == 1
-            and first_boot and row[I_TIME] > now):
-        logger.msg("TRACE","adding time: %s, state: %d" % (row[I_TIME],state))
-        result.append((date2sql(day),row[I_TIME],1))
-        first_boot = False
-    # at this stage we have to peek into the next day
-    day = day + delta
+      elif (state == 1 and row_state == 1):
+        logger.msg("TRACE","adding time: %s, state: %d",time,state)
+        result.append((day,time,state,0))
+        if day > today and time > 0 and (
+            halt is None or 86400*day + time - halt >= 60*min_downtime):
+          found.add(state)
+      elif (state > 1 and row_state == 1 and day == today):
+        result.append((day,time,1,1))
 
-  # for debug-purposes, print list
-  if logger.is_level("DEBUG"):
-    logger.msg("DEBUG","state-changes before consolidation: %d" % len(result))
-    print_results(options,result,True)
+  return result
 
-  # finish here, if raw values were requested
-  if raw:
-    return result
+# --- query cached state-changes   ------------------------------------------
 
-  # now we consolidate the periods
-  delta = datetime.timedelta(minutes=options.min_downtime)
-  i = 0
-  day = datetime.date.today().strftime("%Y-%m-%d")
-  while True and len(result):
-    if i >= len(result)-1:
-      break
-    (day_c,time_c,state_c) = result[i]
-    logger.msg("TRACE","examining: %s,%s,%d" % (day_c,time_c,state_c))
-    if day_c == day and time_c < now:
+def cached_uptimes(options,today):
+  """ return aggregated state-changes from the cache
+
+      The cache is valid if it was created today for the current
+      generation of the schedule, the host, the time-horizon and
+      min_downtime. Otherwise it is recreated. The daemon additionally
+      keeps the state-changes in memory (options.timeline).
+  """
+
+  key = (today,eval_host(options))
+  timeline = getattr(options,'timeline',None)
+  if timeline and timeline[0] == key:
+    logger.msg("DEBUG","using state-changes in memory")
+    return timeline[1]
+  elif getattr(options,'serve',False):
+    options.timeline = (key,cached_uptimes_db(options,today))
+    return options.timeline[1]
+  else:
+    return cached_uptimes_db(options,today)
+
+# --- query cached state-changes from the database   ------------------------
+
+def cached_uptimes_db(options,today):
+  """ return aggregated state-changes from the cache-table """
+
+  db = open_db(options)
+  cursor = db.cursor()
+  cursor.execute("select key,value from meta")
+  meta = dict(cursor.fetchall())
+
+  if (meta.get('cache_generation') == meta.get('generation') and
+      meta.get('cache_day') == today and
+      meta.get('cache_host') == eval_host(options) and
+      meta.get('cache_horizon') == options.time_horizon and
+      meta.get('cache_min_downtime') == options.min_downtime):
+    logger.msg("DEBUG","using cached state-changes")
+    with timings.phase("query cache"):
+      cursor.execute("""select day,time,state,candidate from state_cache
+                          order by seq""")
+      return cursor.fetchall()
+
+  logger.msg("DEBUG","recreating cache of state-changes")
+  with timings.phase("aggregation"):
+    result = aggregate_uptimes(options,today)
+  cache_meta = [('cache_generation',meta.get('generation')),
+                ('cache_day',today),
+                ('cache_host',eval_host(options)),
+                ('cache_horizon',options.time_horizon),
+                ('cache_min_downtime',options.min_downtime)]
+  if not getattr(options,'read_only',False):
+    try:
+      update_cache(db,result,cache_meta)
+    except sqlite3.Error as e:
+      # not fatal, we just recreate the cache next time
+      logger.msg("WARN","could not update cache: %s",e)
+  elif os.access(options.db_name,os.W_OK):
+    # read-only commands (e.g. a polled get) update the cache with a short
+    # write on a separate connection, failures are ignored
+    try:
+      rw_db = sqlite3.connect(options.db_name,timeout=CACHE_BUSY_TIMEOUT)
+      try:
+        update_cache(rw_db,result,cache_meta)
+      finally:
+        rw_db.close()
+    except sqlite3.Error as e:
+      logger.msg("DEBUG","could not update cache: %s",e)
+  return result
+
+# --- update cache of state-changes   ---------------------------------------
+
+def update_cache(db,result,cache_meta):
+  """ replace the cached state-changes (single transaction) """
+
+  with db, timings.phase("update cache"):
+    cursor = db.cursor()
+    cursor.execute("DELETE FROM state_cache")
+    cursor.executemany("""INSERT INTO state_cache (day,time,state,candidate)
+                            VALUES (?,?,?,?)""",result)
+    cursor.executemany("INSERT OR REPLACE INTO meta VALUES (?,?)",cache_meta)
+
+# --- merge uptime periods   ------------------------------------------------
+
+def merge_uptimes(states,today,now,min_downtime):
+  """ merge uptime periods separated by less than min_downtime minutes
+
+      This is a single pass over the list of state-changes (day,time,state).
+      Events of today before now are skipped, up-events are never removed and
+      a down-event is removed together with the next event if the downtime
+      is shorter than min_downtime. Days are epoch-days, times are seconds.
+  """
+
+  delta  = 60*min_downtime
+  result = []
+  n      = len(states)
+  i      = 0
+  while i < n-1:
+    (day_c,time_c,state_c) = states[i]
+    logger.msg("TRACE","examining: %d,%d,%d",day_c,time_c,state_c)
+    if day_c == today and time_c < now:
       # skip events in the past
-      del result[i]    # deletes current entry
+      i += 1
       continue
     if state_c:
       # never remove an up-event
+      result.append(states[i])
       i += 1
       continue
-    (day_n,time_n,state_n) = result[i+1]
-    dt_c = sql2datetime(day_c,time_c)
-    dt_n = sql2datetime(day_n,time_n)
-    if (dt_c + delta > dt_n):
-      logger.msg("TRACE","deleting %r" % (result[i],))
-      del result[i]    # deletes current down
-      logger.msg("TRACE","deleting %r" % (result[i],))
-      del result[i]    # deletes next up
+    (day_n,time_n,_) = states[i+1]
+    if 86400*day_c + time_c + delta > 86400*day_n + time_n:
+      # drop current down and next up
+      logger.msg("TRACE","deleting %r",states[i])
+      logger.msg("TRACE","deleting %r",states[i+1])
     else:
-      # skip to next down
-      i += 2
-
-  # for debug-purposes, print list
-  if logger.is_level("DEBUG"):
-    logger.msg("DEBUG","state-changes after consolidation: %d" % len(result))
-    print_results(options,result,True)
+      # keep both and skip to next down
+      result.append(states[i])
+      result.append(states[i+1])
+    i += 2
 
+  # the last event is never removed
+  result.extend(states[i:])
   return result
 
+# --- simulate settings   ---------------------------------------------------
+
+def do_simulate(options):
+  """ replay the schedule for a number of days with candidate settings
+
+      simulate [days] [setting=values ...]
+
+      setting is one of SIMULATE_SETTINGS, values are lists and ranges of
+      minutes like 5,10,30 or 0-60/10 (default: the value of the
+      config-file). Every combination is reported with the number of boots,
+      the uptime and the shortest downtime.
+  """
+
+  itertools = lazy_import('itertools')
+  days,candidates = SIMULATE_DAYS,{}
+  try:
+    for arg in options.args:
+      key,sep,values = arg.partition('=')
+      if not sep:
+        days = int(arg)
+      elif key in SIMULATE_SETTINGS:
+        candidates[key] = simulate_values(values)
+      else:
+        raise ValueError("unknown setting %s" % key)
+    if days < 1:
+      raise ValueError("invalid number of days: %d" % days)
+  except ValueError as e:
+    logger.msg("ERROR","simulate: %s",e)
+    sys.exit(3)
+  settings = list(itertools.product(
+    *[candidates.get(key,[getattr(options,key)]) for key in SIMULATE_SETTINGS]))
+  logger.msg("INFO","simulate: %d settings for %d days",len(settings),days)
+
+  # a single pass of the evaluation for all settings
+  first = date2day(datetime.date.today())
+  last  = first + days - 1
+  with timings.phase("query schedule"):
+    rows = open_db(options).execute(AGGREGATE_STMT.format(AGGREGATE_COLS,""),
+                                    (eval_host(options),first)).fetchall()
+  with timings.phase("aggregation"):
+    ups,downs = simulate_states(rows,first,last)
+  logger.msg("DEBUG","simulate: %d uptime periods",len(ups))
+
+  with timings.phase("simulation"):
+    results = simulate_settings(ups,downs,86400*first,86400*(last+1),settings)
+    table   = options.format == 'table'
+    records = (tuple(setting) +
+               (boots,round(uptime/3600,2),
+                ("-" if shortest is None else "%.1f" % (shortest/60)) if table
+                else None if shortest is None else round(shortest/60,2))
+               for setting,boots,uptime,shortest in results)
+    write_records(options.format,SIMULATE_FIELDS,records,
+                  (SIMULATE_HEADER,SIMULATE_SEP,SIMULATE_FORMAT))
+
+# --- candidate values of a setting   ---------------------------------------
+
+def simulate_values(text):
+  """ return sorted list of values of a list of values and ranges """
+
+  values = set()
+  for item in text.split(','):
+    span,_,step = item.partition('/')
+    start,_,end = span.partition('-')
+    values.update(range(int(start),int(end or start)+1,int(step or 1)))
+  if not values:
+    raise ValueError("no values: %s" % text)
+  return sorted(values)
+
+# --- boots and halts without consolidation   -------------------------------
+
+def simulate_states(rows,first,last):
+  """ return lists (ups,downs) of the boots and halts (in seconds since the
+      epoch) of the schedule between the epoch-days first and last
+
+      This is the aggregation of aggregate_rows() for the whole range
+      without consolidation. downs[i] is the end of the period starting at
+      ups[i], the last period might still be open.
+  """
+
+  ups,downs,state = [],[],0
+  for day,events in occurrences(rows,first,last):
+    for (time,row_state,_) in events:
+      if row_state == 1:
+        state += 1
+        if state == 1:
+          ups.append(86400*day + time)
+      elif state:
+        state -= 1
+        if not state:
+          downs.append(86400*day + time)
+  return ups,downs
+
+# --- evaluate settings   ---------------------------------------------------
+
+def simulate_settings(ups,downs,start,end,settings):
+  """ yield (setting,boots,uptime,shortest downtime) for every setting
+      (min_downtime,grace_boot,grace_halt) (times in seconds)
+
+      A downtime is kept if it is at least min_downtime minutes and
+      longer than the grace-periods (otherwise the boot would be before
+      the halt). With the downtimes sorted once, the kept ones of a setting
+      are a suffix of the list: a binary search (vectorized, if numpy is
+      available) and sums of the suffixes replace a consolidation for
+      every setting.
+  """
+
+  itertools = lazy_import('itertools')
+  gaps   = sorted(up - down for down,up in zip(downs,ups[1:]))
+  suffix = list(itertools.accumulate(reversed(gaps),initial=0))[::-1]
+  uptime = sum(down - up for up,down in zip(ups,downs+[end]))
+
+  thresholds = [max(60*min_downtime,60*(grace_boot+grace_halt)+1)
+                for (min_downtime,grace_boot,grace_halt) in settings]
+  try:
+    numpy = lazy_import('numpy')
+    kept = numpy.searchsorted(numpy.array(gaps),thresholds).tolist()
+  except ImportError:
+    bisect = lazy_import('bisect')
+    kept = [bisect.bisect_left(gaps,t) for t in thresholds]
+
+  for setting,k in zip(settings,kept):
+    _,grace_boot,grace_halt = setting
+    grace = 60*(grace_boot+grace_halt)
+    boots,total = len(gaps)-k,uptime + suffix[0]-suffix[k]
+    total += boots*grace
+    if ups:
+      # grace-periods of the first boot and the last halt
+      lead   = min(60*grace_boot,ups[0]-start)
+      boots += 1 if ups[0]-60*grace_boot > start else 0
+      total += lead + (min(60*grace_halt,end-downs[-1])
+                       if len(downs) == len(ups) else 0)
+    yield setting,boots,total,gaps[k]-grace if k < len(gaps) else None
+
+# --- settings of the fleet-evaluation   ------------------------------------
+
+FleetSettings = collections.namedtuple('FleetSettings',FLEET_SETTINGS)
+
+# --- evaluate schedule of all hosts   --------------------------------------
+
+def do_fleet(options):
+  """ evaluate the schedule of all hosts
+
+      fleet get:  next halt and boot for every host of the schedule
+      fleet list: hosts and their number of entries ('*' is all hosts)
+
+      The rows of all hosts are read in a single pass. The hosts are
+      evaluated in a process-pool if there are at least FLEET_POOL_MIN hosts
+      (and more than one cpu).
+  """
+
+  fleet_type = options.args[0] if len(options.args) else 'get'
+  logger.msg("INFO","fleet: %s",fleet_type)
+  cursor = open_db(options).cursor()
+
+  if fleet_type == 'list':
+    cursor.execute("""select host,count(*) from schedule
+                        group by host order by host""")
+    print(FLEET_LIST_HEADER)
+    print(FLEET_LIST_SEP)
+    for (host,count) in cursor:
+      print(FLEET_LIST_FORMAT.format(host or '*',count))
+    return
+  elif fleet_type != 'get':
+    print("the fleet command needs a single option get|list")
+    return
+
+  # split rows into common rows (all hosts) and rows of every host
+  today = date2day(datetime.date.today())
+  with timings.phase("query schedule"):
+    cursor.execute("select " + AGGREGATE_COLS + """,host
+                        from schedule not indexed where """ + AGGREGATE_WHERE,
+                   (None,today))
+    common,host_rows = [],{}
+    for row in cursor:
+      if row[6] is None:
+        common.append(row[:6])
+      else:
+        host_rows.setdefault(row[6],[]).append(row[:6])
+  settings = FleetSettings(*[getattr(options,key) for key in FLEET_SETTINGS])
+  jobs = [(host,common+rows,settings)
+          for host,rows in sorted(host_rows.items())]
+
+  with timings.phase("evaluation"):
+    if len(jobs) < FLEET_POOL_MIN or os.cpu_count() == 1:
+      results = [fleet_host(job) for job in jobs]
+    else:
+      futures = lazy_import('concurrent.futures')
+      with futures.ProcessPoolExecutor(initializer=fleet_init,
+                                       initargs=(options.level,)) as pool:
+        results = list(pool.map(fleet_host,jobs,
+                                chunksize=max(1,len(jobs)//(4*os.cpu_count()))))
+
+  print(FLEET_HEADER)
+  print(FLEET_SEP)
+  for (host,halt,boot) in results:
+    print(FLEET_FORMAT.format(host,halt or '-',boot or '-'))
+
+# --- initialize a worker of the fleet-evaluation   -------------------------
+
+def fleet_init(level):
+  """ initialize the logger of a worker-process """
+
+  global logger
+  logger = Msg(level)
+
+# --- evaluate schedule of a single host   ----------------------------------
+
+def fleet_host(job):
+  """ return (host,halt,boot) for the rows of a host
+
+      The job carries the settings (FleetSettings), workers don't depend on
+      global state besides the logger.
+  """
+
+  host,rows,settings = job
+  today  = date2day(datetime.date.today())
+  states = consolidate_uptimes(settings,
+             aggregated=aggregate_rows(rows,today,settings.time_horizon,
+                                       settings.min_downtime))
+  events = [next_event(settings,states,get_type) for get_type in
+            ['halt','boot']]
+  return (host,) + tuple(event[0] if event else None for event in events)
+
+# --- signature of files (for change detection)   --------------------------
+
+def file_signature(*files):
+  """ return tuple of modification times (None for missing files) """
+
+  result = []
+  for f in files:
+    try:
+      result.append(os.stat(f).st_mtime_ns)
+    except OSError:
+      result.append(None)
+  return tuple(result)
+
+# --- reload configuration and data if necessary   --------------------------
+
+def check_reload(options):
+  """ reload settings and drop cached data if files changed """
+
+  signature = file_signature(options.config_file)
+  if signature != getattr(options,'config_signature',None):
+    logger.msg("INFO","loading settings from %s",options.config_file)
+    read_settings(options)
+    options.config_signature = signature
+    options.timeline = None
+
+  signature = file_signature(options.db_name,options.db_name+"-wal")
+  if signature != getattr(options,'db_signature',None):
+    logger.msg("DEBUG","database changed, dropping state-changes in memory")
+    options.db_signature = signature
+    options.timeline = None
+
+# --- handler for requests of clients   -------------------------------------
+
+class RequestHandler(object):
+  """ handle a single request: one line of json in, one line of json out
+      (mixin for socketserver.StreamRequestHandler, see do_serve)
+
+      request: {"cmd": cmd, "args": [...], "db": path, "config": path,
+                "host": host, "level": level, "timings": format,
+                "format": format, "stdin": text}
+      reply:   {"rc": exit-code, "stdout": text, "stderr": text} or
+               {"error": text} if the request is not served
+  """
+
+  def handle(self):
+    """ handle request """
+
+    options = self.server.options
+    json    = lazy_import('json')
+    try:
+      request = json.loads(self.rfile.readline().decode('utf-8'))
+      if request.get('cmd') not in SERVED_COMMANDS:
+        reply = {'error': "command not served: %s" % request.get('cmd')}
+      elif os.path.abspath(request.get('db','')) != options.db_name:
+        reply = {'error': "database not served: %s" % request.get('db')}
+      elif os.path.abspath(request.get('config','')) != options.config_file:
+        reply = {'error': "config-file not served: %s" %
+                 request.get('config')}
+      else:
+        reply = self.execute(options,request)
+    except ValueError as e:
+      reply = {'error': "invalid request: %s" % e}
+    self.wfile.write((json.dumps(reply)+"\n").encode('utf-8'))
+
+  def execute(self,options,request):
+    """ execute the command of the request, capturing the output """
+
+    global logger, timings
+    io = lazy_import('io')
+    options.cmd  = request['cmd']
+    options.args = list(request.get('args',[]))
+    options.host = request.get('host')
+    options.format = request.get('format','table')
+    stdin,stdout,stderr = (io.StringIO(request.get('stdin','')),
+                           io.StringIO(),io.StringIO())
+    daemon_logger,daemon_timings = logger,timings
+    logger  = Msg(request.get('level',daemon_logger._level))
+    timings = Timings(request.get('timings'),time.perf_counter())
+    rc = 0
+    try:
+      with contextlib.redirect_stdout(stdout), \
+           contextlib.redirect_stderr(stderr):
+        sys.stdin = stdin
+        check_reload(options)
+        with timings.phase("command %s" % options.cmd):
+          globals()["do_%s" % options.cmd](options)
+        timings.report()
+    except SystemExit as e:
+      rc = e.code
+    except Exception as e:
+      rc = 3
+      stderr.write("[ERROR] Exception: %s\n" % e)
+    finally:
+      sys.stdin = sys.__stdin__
+      logger,timings = daemon_logger,daemon_timings
+    return {'rc': rc, 'stdout': stdout.getvalue(), 'stderr': stderr.getvalue()}
+
+# --- run as a daemon   -----------------------------------------------------
+
+def do_serve(options):
+  """ serve requests on a unix-socket
+
+      The daemon keeps the settings, the open database and the aggregated
+      state-changes in memory. Settings are reloaded if the config-file
+      changes, cached data is dropped if the database changes.
+  """
+
+  options.db_name     = os.path.abspath(options.db_name)
+  options.config_file = os.path.abspath(options.config_file)
+  options.serve       = True
+  check_reload(options)
+
+  socketserver = lazy_import('socketserver')
+  signal       = lazy_import('signal')
+  class StreamRequestHandler(RequestHandler,
+                             socketserver.StreamRequestHandler):
+    pass
+
+  if os.path.exists(options.socket_name):
+    os.remove(options.socket_name)
+  server = socketserver.UnixStreamServer(options.socket_name,
+                                         StreamRequestHandler)
+  server.options = options
+
+  def on_signal(signum,frame):
+    sys.exit(0)
+  signal.signal(signal.SIGTERM,on_signal)
+
+  logger.msg("INFO","serving %s on %s",options.db_name,options.socket_name)
+  try:
+    server.serve_forever()
+  finally:
+    server.server_close()
+    os.remove(options.socket_name)
+
+# --- execute command by the daemon   ---------------------------------------
+
+def call_daemon(options):
+  """ execute command by the daemon
+
+      Returns the exit-code of the command or None if the daemon is not
+      available (or does not serve the command, database or config-file).
+  """
+
+  if (options.cmd not in SERVED_COMMANDS or not options.socket_name or
+      not os.path.exists(options.socket_name)):
+    return None
+
+  io,json,socket = [lazy_import(m) for m in ['io','json','socket']]
+  request = {'cmd':   options.cmd,
+             'args':  options.args,
+             'db':    os.path.abspath(options.db_name),
+             'config': os.path.abspath(options.config_file),
+             'host':  options.host,
+             'level': options.level,
+             'timings': options.timings,
+             'format':  options.format}
+  if options.args[:1] == ['-']:
+    request['stdin'] = sys.stdin.read()
+    sys.stdin = io.StringIO(request['stdin'])     # in case of a fallback
+
+  try:
+    with socket.socket(socket.AF_UNIX,socket.SOCK_STREAM) as sock:
+      sock.connect(options.socket_name)
+      sock.sendall((json.dumps(request)+"\n").encode('utf-8'))
+      reply = json.loads(sock.makefile('rb').readline().decode('utf-8'))
+  except (OSError,ValueError) as e:
+    logger.msg("DEBUG","daemon not available: %s",e)
+    return None
+
+  if 'error' in reply:
+    logger.msg("DEBUG","daemon: %s",reply['error'])
+    return None
+  sys.stderr.write(reply['stderr'])
+  sys.stdout.write(reply['stdout'])
+  return reply['rc']
+
+# ---------------------------------------------------------------------------
+# --- helper-class for inotify   --------------------------------------------
+
+class Inotify(object):
+  """ minimal interface to inotify (Linux only, uses ctypes) """
+
+  IN_MODIFY   = 0x002
+  IN_MOVED_TO = 0x080
+  IN_CREATE   = 0x100
+  IN_DELETE   = 0x200
+  EVENT       = "iIII"          # wd, mask, cookie, len (followed by the name)
+
+  def __init__(self):
+    ctypes = lazy_import('ctypes')
+    self._libc = ctypes.CDLL(None,use_errno=True)
+    self._dirs = {}
+    self.fd    = self._libc.inotify_init1(os.O_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(),"inotify_init1 failed")
+
+  # --- watch a directory   -------------------------------------------------
+
+  def add_dir(self,path):
+    """ watch all files of a directory (files might be replaced) """
+    mask = self.IN_MODIFY | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+    wd   = self._libc.inotify_add_watch(self.fd,os.fsencode(path),mask)
+    if wd < 0:
+      raise OSError(lazy_import('ctypes').get_errno(),
+                    "cannot watch %s" % path)
+    self._dirs[wd] = path
+
+  # --- read events   -------------------------------------------------------
+
+  def read(self,timeout=None):
+    """ wait for events and return list of (path,mask), empty on timeout """
+    select,struct = lazy_import('select'),lazy_import('struct')
+    if not select.select([self.fd],[],[],timeout)[0]:
+      return []
+    buf    = os.read(self.fd,65536)
+    size   = struct.calcsize(self.EVENT)
+    events = []
+    offset = 0
+    while offset < len(buf):
+      wd,mask,_,length = struct.unpack_from(self.EVENT,buf,offset)
+      name    = os.fsdecode(buf[offset+size:offset+size+length].rstrip(b'\0'))
+      offset += size + length
+      events.append((os.path.join(self._dirs.get(wd,''),name),mask))
+    return events
+
+  # --- close   -------------------------------------------------------------
+
+  def close(self):
+    """ stop watching """
+    os.close(self.fd)
+
+# --- wait for a burst of changes   -----------------------------------------
+
+def watch_burst(inotify,files):
+  """ block until some of the files change, then wait until the burst of
+      changes is over. Returns a dict path -> mask (or-ed events).
+  """
+
+  changed = {}
+  while not changed:
+    for path,mask in inotify.read():
+      if path in files:
+        changed[path] = changed.get(path,0) | mask
+
+  # debounce: wait for WATCH_DEBOUNCE seconds without changes
+  last     = time.monotonic()
+  deadline = last + WATCH_MAX_DELAY
+  while True:
+    timeout = min(last+WATCH_DEBOUNCE,deadline) - time.monotonic()
+    if timeout <= 0:
+      return changed
+    for path,mask in inotify.read(timeout):
+      if path in files:
+        changed[path] = changed.get(path,0) | mask
+        last = time.monotonic()
+
+# --- query change-counter of the database   --------------------------------
+
+def data_version(options):
+  """ return (data_version,generation) of the database
+
+      data_version only changes with commits of other connections.
+  """
+
+  cursor = open_db(options).cursor()
+  version = cursor.execute("PRAGMA data_version").fetchone()[0]
+  cursor.execute("select value from meta where key='generation'")
+  return version,cursor.fetchone()[0]
+
+# --- checksum of schedule and classes   ------------------------------------
+
+def content_signature(options):
+  """ return a checksum of the schedule and the classes
+
+      Other tables (meta, state_cache) are also written by read-only
+      commands and by set, these writes don't change the evaluation.
+  """
+
+  cursor = open_db(options).cursor()
+  schedule = tuple(cursor.execute("select * from schedule order by rowid"))
+  classes  = tuple(cursor.execute("select * from classes order by rowid"))
+  return hash((schedule,classes))
+
+# --- re-apply halt and boot times on changes   -----------------------------
+
+def do_watch(options):
+  """ re-apply halt and boot times (set both) whenever the schedule or the
+      settings change
+
+      The watcher blocks on inotify-events of the database (including the
+      WAL- and journal-file) and of the config-file, it never polls.
+      Bursts of writes are applied once (see watch_burst). Since our own
+      writes trigger events too, changes are confirmed with data_version.
+      Writers that do not bump the generation (e.g. sqlite3 used
+      directly) would leave a stale cache, so we bump it for them if the
+      schedule or the classes changed. Other foreign commits are ignored.
+  """
+
+  options.db_name     = os.path.abspath(options.db_name)
+  options.config_file = os.path.abspath(options.config_file)
+  options.args        = ['both']
+  files = [options.db_name+suffix for suffix in ['','-wal','-journal']]
+  files.append(options.config_file)
+  try:
+    inotify = Inotify()
+    for path in set(os.path.dirname(f) for f in files):
+      inotify.add_dir(path)
+  except (OSError,AttributeError) as e:
+    logger.msg("ERROR","cannot watch files: %s",e)
+    sys.exit(3)
+
+  signal = lazy_import('signal')
+  def on_signal(signum,frame):
+    sys.exit(0)
+  signal.signal(signal.SIGTERM,on_signal)
+
+  version   = data_version(options)
+  signature = content_signature(options)
+  do_set(options)
+  logger.msg("INFO","watching %s",options.db_name)
+  try:
+    while True:
+      changed = watch_burst(inotify,files)
+      reapply = False
+      if options.config_file in changed:
+        if not os.path.exists(options.config_file):
+          logger.msg("WARN","config-file %s deleted",options.config_file)
+          continue
+        logger.msg("INFO","reloading settings from %s",options.config_file)
+        read_settings(options)
+        reapply = True
+      if changed.get(options.db_name,0) & (Inotify.IN_CREATE |
+                                           Inotify.IN_MOVED_TO |
+                                           Inotify.IN_DELETE):
+        # the database was replaced (or deleted)
+        close_db(options)
+        if not os.path.exists(options.db_name):
+          logger.msg("WARN","database %s deleted",options.db_name)
+          continue
+        do_migrate(options)
+        version,reapply = None,True
+
+      new_version = data_version(options)
+      if version and new_version[0] != version[0]:
+        if new_version[1] != version[1]:
+          reapply = True
+        elif content_signature(options) != signature:
+          reapply = True
+          exec_sql(options,BUMP_GENERATION_STMT,commit=True)
+      if not reapply:
+        logger.msg("DEBUG","no changes of schedule or classes")
+        version = new_version
+        continue
+      version   = data_version(options)
+      signature = content_signature(options)
+      logger.msg("INFO","changes detected, re-applying halt and boot")
+      do_set(options)
+  finally:
+    inotify.close()
+
 # --- read settings   ------------------------------------------------------
 
 def read_settings(options):
-  """ read settings from /etc/uptime-manager.json """
+  """ read settings from /etc/uptime-manager.json (or --config) """
 
-  if not os.path.exists(CONFIG_FILE):
-    logger.msg("ERROR","cannot read config-file %s" % CONFIG_FILE)
+  if not os.path.exists(options.config_file):
+    logger.msg("ERROR","cannot read config-file %s",options.config_file)
     sys.exit(3)
   else:
-    logger.msg("DEBUG","reading settings from %s" % CONFIG_FILE)
-    with open(CONFIG_FILE,"r") as f:
-      settings = json.load(f)
+    logger.msg("DEBUG","reading settings from %s",options.config_file)
+    with open(options.config_file,"r") as f:
+      apply_settings(options,lazy_import('json').load(f))
+
+# --- apply settings   ------------------------------------------------------
+
+def apply_settings(options,settings):
+  """ set options from the settings (a dict, see read_settings) """
+
+  options.grace_boot     = settings["grace_boot"]
+  options.grace_halt     = settings["grace_halt"]
+  options.min_downtime   = settings["min_downtime"]
+  options.auto_set       = settings["auto_set"]
+  options.time_horizon   = settings.get("time_horizon",MAX_TIME_HORIZON)
+  options.busy_timeout   = settings.get("busy_timeout",BUSY_TIMEOUT)
+  options.retention_days = settings.get("retention_days",0)
+  options.auto_clean     = settings.get("auto_clean",False)
+
+# --- results of the in-process api   ---------------------------------------
+
+Entry       = collections.namedtuple('Entry',['id','cls','label','type','value',
+                                     'start','end','enabled','host'])
+Uptime      = collections.namedtuple('Uptime',['time','cls','label','type',
+                                      'value','up','id'])
+StateChange = collections.namedtuple('StateChange',['time','up'])
+
+# --- errors of the in-process api   ----------------------------------------
+
+class UptimeManagerError(Exception):
+  """ error of an UptimeManager-operation """
+  pass
+
+# --- in-process api   ------------------------------------------------------
+
+class UptimeManager(object):
+  """ in-process api: manage uptimes without starting um_ctrl.py
+
+      All operations share a single connection. Values are returned as
+      named tuples (DATE-values as datetime.date, times as datetime.time
+      or datetime.datetime). Errors raise UptimeManagerError.
+
+        sys.path.insert(0,"/usr/local/sbin")
+        import um_ctrl
+        with um_ctrl.UptimeManager() as um:
+          um.add('office','morning','DOW',1,'08:00-12:00')
+          print(um.next_halt())
+
+      The hooks are never called, use "um_ctrl.py set" for this.
+  """
+
+  def __init__(self,db_name=DEFAULT_DB,config_file=CONFIG_FILE,settings=None,
+               host=None,read_only=False,create=False,level="NONE"):
+    """ open the database (create a missing schema if create is set).
+        settings is a dict like the config-file, which is only read if
+        settings is None """
+
+    self.options = Options()
+    for key,value in get_defaults().items():
+      setattr(self.options,key,value)
+    self.options.db_name      = db_name
+    self.options.config_file  = config_file
+    self.options.host         = host
+    self.options.read_only    = read_only
+    self.options.STATE_VALUES = ['down','up']
+    self.logger = Msg(level)
+
+    with self._scope() as options:
+      if settings is None:
+        read_settings(options)
+      else:
+        try:
+          apply_settings(options,settings)
+        except KeyError as e:
+          raise UptimeManagerError("missing setting %s" % e)
+      if create and not read_only and get_schema_version(options) == 0:
+        do_create(options)
+      else:
+        do_migrate(options)
+
+  # --- run module-functions   ----------------------------------------------
 
-  options.grace_boot   = settings["grace_boot"]
-  options.grace_halt   = settings["grace_halt"]
-  options.min_downtime = settings["min_downtime"]
-  options.auto_set     = settings["auto_set"]
+  @contextlib.contextmanager
+  def _scope(self):
+    """ run module-functions with the logger of this instance and convert
+        errors (the functions exit the program or raise ValueError for
+        invalid arguments) to UptimeManagerError """
+
+    global logger, timings
+    saved = logger,timings
+    logger,timings = self.logger,Timings()
+    try:
+      yield self.options
+    except SystemExit as e:
+      raise UptimeManagerError(self.logger.last_error or
+                               "failed with exit-code %s" % e.code)
+    except ValueError as e:
+      # invalid arguments (e.g. times or values)
+      raise UptimeManagerError(str(e))
+    finally:
+      logger,timings = saved
+
+  # --- context-manager   ---------------------------------------------------
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self,*exc):
+    self.close()
+
+  # --- close database   ----------------------------------------------------
+
+  def close(self):
+    """ close the database """
+    with self._scope() as options:
+      close_db(options)
+
+  # --- add entries   -------------------------------------------------------
+
+  def add(self,cls,label,dtype,value,interval):
+    """ add an entry and return its id
+
+        value is an int or a rule like '1-5' (DOW, DOM), a datetime.date
+        or a tuple of two dates (or dd.mm.yyyy[-dd.mm.yyyy]),
+        interval is 'hh:mm-hh:mm' or a tuple of datetime.time.
+    """
+    return self.add_entries([(cls,label,dtype,value,interval)])[0]
+
+  def add_entries(self,entries):
+    """ add entries (see add) in a single transaction, return their ids """
+
+    with self._scope() as options:
+      return do_add_sql(options,self._entry_args(entries))
+
+  # --- apply a desired state   ---------------------------------------------
+
+  def apply(self,entries,classes=None):
+    """ replace the entries (of the classes) by the given entries, only
+        the differences are written. Returns True if entries changed. """
+
+    classes = list(classes or [])
+    with self._scope() as options:
+      id_row = dict(entry2row(sql_args,host=options.host)
+                    for sql_args in self._entry_args(entries)
+                    if not classes or sql_args[0] in classes)
+      scope  = ("" if not classes else
+                " and class in (%s)" % ",".join(len(classes)*"?"))
+      return sync_entries(options,"apply",id_row,scope,classes)
+
+  # --- convert entries to arguments of add   -------------------------------
+
+  @staticmethod
+  def _entry_args(entries):
+    """ convert entries with values and intervals as date/time-objects """
+
+    args = []
+    for (cls,label,dtype,value,interval) in entries:
+      if isinstance(value,datetime.date):
+        value = value.strftime("%d.%m.%Y")
+      elif isinstance(value,tuple):
+        value = "-".join(date.strftime("%d.%m.%Y") for date in value)
+      if not isinstance(interval,str):
+        # same text as export, so ids of equal entries match
+        interval = "-".join(t.strftime("%H:%M" if not t.second else
+                                       "%H:%M:%S") for t in interval)
+      args.append([cls,label,dtype,str(value),interval])
+    return args
+
+  # --- delete entries   ----------------------------------------------------
+
+  def delete(self,id_or_class,label=None):
+    """ delete entries with given id or class (and label) """
+
+    spec = [str(id_or_class)] + ([label] if label is not None else [])
+    with self._scope() as options:
+      del_entries(options,[spec])
+
+  # --- enable/disable classes or entries   ---------------------------------
+
+  def enable(self,*names):
+    """ enable classes or entries (ids) """
+    with self._scope() as options:
+      exec_batch(options,enable_batch(options,[str(n) for n in names],1)+
+                         [(BUMP_GENERATION_STMT,[()])])
+
+  def disable(self,*names):
+    """ disable classes or entries (ids) """
+    with self._scope() as options:
+      exec_batch(options,enable_batch(options,[str(n) for n in names],0)+
+                         [(BUMP_GENERATION_STMT,[()])])
+
+  # --- query entries   -----------------------------------------------------
+
+  def entries(self):
+    """ return list of Entry for all entries of the database """
+
+    with self._scope() as options:
+      cursor = open_db(options).execute(SCHEDULE_SELECT +
+                                        " order by s.class,label,id")
+      return [Entry(id,cls,label,dtype,api_value(dtype,value,since,until),
+                    secs2api(start),secs2api(end),enabled,host)
+              for (cls,label,dtype,value,since,until,start,end,id,enabled,
+                   host)
+              in cursor]
+
+  # --- list uptimes   ------------------------------------------------------
+
+  def list(self,date=None,days=1):
+    """ return list of Uptime for days starting at date (default: today) """
+
+    with self._scope() as options:
+      return [Uptime(day2api(day,time),cls,label,dtype,api_value(dtype,value),
+                     state == 1,id)
+              for (day,cls,label,dtype,value,state,time,id,_) in
+              fetch_uptimes(options,date or datetime.date.today(),days)]
+
+  # --- state-changes and next halt/boot   ----------------------------------
+
+  def states(self,raw=False):
+    """ return list of StateChange (consolidated unless raw) """
+
+    with self._scope() as options:
+      return [StateChange(day2api(day,time),state == 1)
+              for (day,time,state) in consolidate_uptimes(options,raw=raw)]
+
+  def next_halt(self):
+    """ return datetime of next halt (including grace-period) or None """
+    return self._next_event('halt')
+
+  def next_boot(self):
+    """ return datetime of next boot (including grace-period) or None """
+    return self._next_event('boot')
+
+  def _next_event(self,get_type):
+    """ return datetime of next halt|boot or None """
+
+    with self._scope() as options:
+      event = next_event(options,consolidate_uptimes(options),get_type)
+      return event[1] if event else None
+
+# --- convert values for the api   ------------------------------------------
+
+def api_value(dtype,value,since=None,until=None):
+  """ return value as datetime.date or tuple of dates (DATE), int or rule
+      (bounded rules in the format of add) """
+
+  if dtype != 'DATE' and (since is not None or until is not None):
+    return value2text(dtype,value,since,until)
+  elif dtype == 'DATE' and until not in [None,value]:
+    return day2date(value),day2date(until)
+  return day2date(value) if dtype == 'DATE' else value
+
+def secs2api(secs):
+  """ return seconds of day as datetime.time """
+
+  return datetime.time(secs // 3600,(secs // 60) % 60,secs % 60)
+
+def day2api(day,secs):
+  """ return epoch-day and seconds of day as datetime.datetime """
+
+  return datetime.datetime.combine(day2date(day),secs2api(secs))
 
 # --- commandline parser   --------------------------------------------------
 
 def get_parser():
+  argparse = lazy_import('argparse')
   parser = argparse.ArgumentParser(add_help=False,
     formatter_class=argparse.RawDescriptionHelpFormatter,
     description='uptime-manager: manage uptimes of a system',
     epilog="""
 Available commands:
   create:                                       (re-) create the database
-  add class label DOW|DOM|DATE value start-end: add uptime period
-  enable class                                  enable uptimes of class
-  disable class                                 disable uptimes of class
-  del id | class [label]:                       delete all entries for id or class or class/label
+  migrate:                                      upgrade database to current version
+  add class label DOW|DOM|DATE value start-end: add uptime period (value: day or rule, e.g. DOW 1-5)
+  apply file|- [class ...]:                     make entries (of classes) match the file (format of add)
+  enable class|id [...]                         enable uptimes of classes or entries
+  disable class|id [...]                        disable uptimes of classes or entries
+  del id | class [label] | -:                   delete all entries for id or class or class/label
   clean:                                        remove old entries of type DATE
   raw:                                          list database (raw mode)
+  import jsonl|csv [file|-]:                    import entries (default: from stdin)
+  import-ics file [class]:                      sync class (default: file-name) with the events of an iCalendar-file
+  export jsonl|csv [file|-]:                    export entries (default: to stdout)
   list [today|week|<date>]:                     list all uptimes (unconsolidated)
   get halt|boot|all|raw:                        get (next) halt-time/boot-time
-  set halt|boot:                                set next halt-time|boot-time (call um_set_halt|um_set_boot)
+  set halt|boot|both:                           set next halt-time|boot-time (call um_set_halt|um_set_boot)
+  simulate [days] [setting=values ...]:         replay the schedule with candidate settings (e.g. min_downtime=5-60/5)
+  fleet get|list:                               get next halt-time/boot-time of all hosts, list hosts
+  serve:                                        run as daemon and serve requests on the socket
+  watch:                                        re-apply halt-time|boot-time whenever the schedule changes
   """)
+  parser.set_defaults(**get_defaults())
   parser.add_argument('-D', '--db', metavar=('database',),
-                      default=DEFAULT_DB,dest='db_name',help='database-file')
-
-  parser.add_argument('-q', '--quiet', default=False, action='store_true',
+                      dest='db_name',help='database-file')
+
+  parser.add_argument('-C', '--config', metavar=('config-file',),
+                      dest='config_file',
+                      help='configuration-file')
+  parser.add_argument('-S', '--socket', metavar=('socket',),
+                      dest='socket_name',
+                      help='socket of the daemon (empty: do not use daemon)')
+
+  parser.add_argument('-H', '--host', metavar=('host',),
+                      dest='host',
+                      help='host of new entries (default: all hosts) '
+                           'or host to evaluate (default: this host)')
+
+  parser.add_argument('-f', '--force', action='store_true',
+    dest='force',
+    help='set: always call hooks (even if halt|boot did not change), '
+         'import-ics: import unchanged files')
+  parser.add_argument('-n', '--dry-run', action='store_true',
+    dest='dry_run',
+    help='apply, import-ics: only print the differences')
+  parser.add_argument('--format', dest='format', choices=OUTPUT_FORMATS,
+    help='output-format of list, raw, get all|raw and simulate '
+         '(default: table)')
+
+  parser.add_argument('-T', '--timings', action='store_const', const='text',
+    dest='timings',
+    help='report timings of all phases to stderr')
+  parser.add_argument('--timings-json', action='store_const', const='json',
+    dest='timings',
+    help='report timings of all phases to stderr (json-format)')
+
+  parser.add_argument('-q', '--quiet', action='store_true',
     dest='quiet',
     help='output no messages')
-  parser.add_argument('-l', '--level', dest='level', default='INFO',
+  parser.add_argument('-l', '--level', dest='level',
                       metavar='debug-level',
                       choices=['NONE','ERROR','WARN','INFO','DEBUG','TRACE'],
     help='debug level: one of NONE, ERROR, WARN, INFO, DEBUG, TRACE')
@@ -708,39 +3321,111 @@ Available commands:
   parser.add_argument('-h', '--help', action='help',
     help='print this help')
 
-  parser.add_argument('cmd',
-     choices=['create','add','enable','disable','del','clean',
-              'raw','list','get','set'],
+  parser.add_argument('cmd', nargs='?',
+     choices=['create','migrate','add','apply','enable','disable','del',
+              'clean','raw','import','import-ics','export','list','get','set',
+              'simulate','fleet','serve','watch'],
                       help='command to execute')
   parser.add_argument('args', nargs='*', metavar='argument',
     help='arguments for given command')
   return parser
 
+# --- default values of options   -------------------------------------------
+
+def get_defaults():
+  """ return default values of the commandline options """
+
+  return {'db_name':         DEFAULT_DB,
+          'config_file':     CONFIG_FILE,
+          'socket_name':     DEFAULT_SOCKET,
+          'host':            None,
+          'force':           False,
+          'dry_run':         False,
+          'format':          'table',
+          'timings':         None,
+          'quiet':           False,
+          'level':           'INFO',
+          'do_version_info': False}
+
+# --- fast commandline parser   ---------------------------------------------
+
+def parse_fast(argv):
+  """ parse simple commandlines like 'set halt' (used by the systemd-unit)
+      without argparse. The only options allowed are the timing-options.
+      Returns None for all other commandlines.
+  """
+
+  fmt  = None
+  args = []
+  for arg in argv:
+    if arg in FAST_TIMINGS:
+      fmt = FAST_TIMINGS[arg]
+    elif arg.startswith('-'):
+      return None
+    else:
+      args.append(arg)
+  if not args or args[0] not in FAST_COMMANDS:
+    return None
+  argv = args
+
+  for key,value in get_defaults().items():
+    setattr(Options,key,value)
+  Options.timings = fmt
+  Options.cmd  = argv[0]
+  Options.args = argv[1:]
+  return Options
+
 # --- main program   --------------------------------------------------------
 
 if __name__ == '__main__':
-  locale.setlocale(locale.LC_ALL, '')
-
-  opt_parser = get_parser()
-  options = opt_parser.parse_args(namespace=Options)
+  options = parse_fast(sys.argv[1:])
+  if not options:
+    opt_parser = get_parser()
+    options = opt_parser.parse_args(namespace=Options)
   if options.do_version_info:
     print("version: %s" % VERSION)
     sys.exit(0)
+  elif not options.cmd:
+    opt_parser.error("missing command")
   else:
     if options.quiet:
       options.level = 'NONE'
     options.pgmdir = os.path.dirname(sys.argv[0])
-    options.DOW = dow_map()                         # map isoweekday to string
     options.STATE_VALUES = ['down','up']
+    options.read_only = options.cmd in READ_ONLY_COMMANDS or options.dry_run
 
-  # configure message-class
+  # configure message-class and timings
   logger = Msg(options.level)
-
-  # read settings
-  read_settings(options)
+  timings.fmt = options.timings
+  timings.add("startup",time.perf_counter()-T_START)
+
+  # use the daemon, if available
+  with timings.phase("daemon"):
+    rc = call_daemon(options)
+  if rc is not None:
+    timings.report()
+    sys.exit(rc)
+
+  # read settings (only if needed)
+  if options.cmd in SETTINGS_COMMANDS:
+    with timings.phase("settings"):
+      read_settings(options)
+
+  # automatically upgrade the schema of an existing database
+  if not options.cmd in ['create','migrate']:
+    with timings.phase("schema check"):
+      do_migrate(options)
 
   # execute command and exit
-  func = globals()["do_%s" % options.cmd]
-  func(options)
+  func = globals()["do_%s" % options.cmd.replace('-','_')]
+  try:
+    with timings.phase("command %s" % options.cmd):
+      func(options)
+  except BrokenPipeError:
+    # the consumer of the output exited early (e.g. head)
+    os.dup2(os.open(os.devnull,os.O_WRONLY),sys.stdout.fileno())
+    sys.exit(1)
+  close_db(options)
+  timings.report()
   sys.exit(0)
 
@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# Uptime-Manager: benchmark all commands of um_ctrl.py with synthetic schedules
+#
+# The benchmark runs offline: every database, configuration and hook is
+# created in a temporary directory. Results are written as json.
+#
+# Author: Bernhard Bablok
+# License: GPL3
+#
+# Website: https://github.com/bablokb/uptime-manager
+#
+# --------------------------------------------------------------------------
+
+DEFAULT_SIZES  = "10,1000,10000,100000"
+DEFAULT_REPEAT = 3
+DEFAULT_SCRIPT = "../files/usr/local/sbin/um_ctrl.py"   # relative to tools
+
+# settings used for the benchmark (no auto_set, so add/del are measured alone)
+SETTINGS = {
+  "grace_boot"   :  3,
+  "grace_halt"   :  3,
+  "min_downtime" : 10,
+  "auto_set"     : False
+  }
+
+# hooks replacing um_set_halt/um_set_boot
+HOOK_STUB = "#!/bin/sh\nexit 0\n"
+
+# commands to benchmark (after the bulk import)
+COMMANDS = [
+  ["add","bench","single","DOW","3","08:00-12:00"],
+  ["list","today"],
+  ["list","week"],
+  ["get","halt"],
+  ["get","boot"],
+  ["get","all"],
+  ["-f","set","both"],
+  ["clean"]
+  ]
+
+# --- system-imports   -----------------------------------------------------
+
+import argparse
+import sys, os, datetime, json, random, shutil, sqlite3, statistics
+import subprocess, tempfile, time, platform
+
+# --- create synthetic schedule   -------------------------------------------
+
+def create_entries(size,seed):
+  """ return list of add-lines with a mix of DOW, DOM and DATE entries
+
+      About a fifth of the entries spans midnight. The entries are spread
+      over five classes, the class 'disabled' is disabled after the import.
+  """
+
+  rnd     = random.Random(seed)
+  today   = datetime.date.today()
+  classes = ['office','backup','maintenance','holiday','disabled']
+  result  = []
+  for i in range(size):
+    dtype = rnd.choice(['DOW','DOW','DOM','DATE'])
+    if dtype == 'DOW':
+      value = str(rnd.randint(1,7))
+    elif dtype == 'DOM':
+      value = str(rnd.randint(1,31))
+    else:
+      value = (today + datetime.timedelta(rnd.randint(-30,60))).strftime(
+        "%d.%m.%Y")
+    start = rnd.randrange(24*60)
+    if rnd.random() < 0.2:
+      # midnight spanning interval
+      end = rnd.randrange(start) if start else 0
+    else:
+      end = min(start + rnd.randint(1,8*60),24*60-1)
+    result.append("%s entry%d %s %s %02d:%02d-%02d:%02d\n" %
+                  (rnd.choice(classes),i,dtype,value,
+                   start//60,start%60,end//60,end%60))
+  return result
+
+# --- run a command   -------------------------------------------------------
+
+def run_cmd(options,args,stdin=None):
+  """ run um_ctrl.py with given arguments and return (seconds,stdout) """
+
+  cmd = [sys.executable,options.script,"-q","-S","",
+         "-C",options.config_file,"-D",options.db_name] + args
+  start = time.perf_counter()
+  proc = subprocess.run(cmd,input=stdin,stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE,universal_newlines=True)
+  seconds = time.perf_counter() - start
+  if proc.returncode:
+    sys.stderr.write("[ERROR] %s: %s\n" % (" ".join(args),proc.stderr))
+  return seconds,proc.stdout
+
+# --- count rows of the schedule   ------------------------------------------
+
+def count_rows(db_name):
+  """ return number of rows in the schedule """
+
+  db = sqlite3.connect(db_name)
+  try:
+    return db.execute("select count(*) from schedule").fetchone()[0]
+  finally:
+    db.close()
+
+# --- remove database   -----------------------------------------------------
+
+def remove_db(db_name):
+  """ remove database together with its -wal and -shm files """
+
+  for path in [db_name,db_name+"-wal",db_name+"-shm"]:
+    if os.path.exists(path):
+      os.remove(path)
+
+# --- benchmark one size   --------------------------------------------------
+
+def bench_size(options,size):
+  """ benchmark all commands for a schedule with size entries """
+
+  results = []
+  def record(name,runs,output):
+    results.append({'entries':  size,
+                    'command':  name,
+                    'rows':     count_rows(options.db_name),
+                    'lines':    len(output.splitlines()),
+                    'runs_ms':  [round(1000*r,3) for r in runs],
+                    'min_ms':   round(1000*min(runs),3),
+                    'median_ms':round(1000*statistics.median(runs),3)})
+
+  remove_db(options.db_name)
+  run_cmd(options,["create"])
+
+  # bulk import via stdin (once, the import is not repeatable)
+  entries = "".join(create_entries(size,options.seed))
+  seconds,output = run_cmd(options,["add","-"],stdin=entries)
+  record("add -",[seconds],output)
+  run_cmd(options,["disable","disabled"])
+
+  for args in COMMANDS:
+    runs = []
+    for _ in range(options.repeat):
+      seconds,output = run_cmd(options,args)
+      runs.append(seconds)
+    record(" ".join(a for a in args if not a.startswith('-')),runs,output)
+  return results
+
+# --- commandline parser   --------------------------------------------------
+
+def get_parser():
+  parser = argparse.ArgumentParser(
+    description='benchmark the commands of um_ctrl.py')
+  parser.add_argument('-D', '--db', metavar='database', default=None,
+    dest='db_name', help='database-file (default: temporary file)')
+  parser.add_argument('--overwrite', action='store_true', dest='overwrite',
+    help='overwrite an existing database-file given with --db')
+  parser.add_argument('-s', '--sizes', default=DEFAULT_SIZES, dest='sizes',
+    help='comma-separated list of schedule-sizes (default: %s)' %
+                      DEFAULT_SIZES)
+  parser.add_argument('-r', '--repeat', type=int, default=DEFAULT_REPEAT,
+    dest='repeat', help='repetitions per command (default: %d)' %
+                      DEFAULT_REPEAT)
+  parser.add_argument('--seed', type=int, default=42, dest='seed',
+    help='seed for the synthetic schedules')
+  parser.add_argument('--script', default=None, dest='script',
+    help='path to um_ctrl.py (default: the one in this repository)')
+  parser.add_argument('-o', '--output', default=None, dest='output',
+    help='output-file (default: stdout)')
+  return parser
+
+# --- main program   --------------------------------------------------------
+
+if __name__ == '__main__':
+  options = get_parser().parse_args()
+  if (options.db_name and os.path.exists(options.db_name) and
+      not options.overwrite):
+    sys.stderr.write("[ERROR] %s exists (use --overwrite to replace it)\n" %
+                     options.db_name)
+    sys.exit(3)
+
+  tmpdir = tempfile.mkdtemp(prefix="um_bench_")
+  try:
+    # copy script next to stub-hooks (um_ctrl.py calls hooks from its dir)
+    script = options.script or os.path.join(os.path.dirname(
+      os.path.abspath(__file__)),DEFAULT_SCRIPT)
+    options.script = os.path.join(tmpdir,"um_ctrl.py")
+    shutil.copy(script,options.script)
+    for hook in ["um_set_halt","um_set_boot"]:
+      path = os.path.join(tmpdir,hook)
+      with open(path,"w") as f:
+        f.write(HOOK_STUB)
+      os.chmod(path,0o755)
+
+    options.config_file = os.path.join(tmpdir,"uptime-manager.json")
+    with open(options.config_file,"w") as f:
+      json.dump(SETTINGS,f)
+    if not options.db_name:
+      options.db_name = os.path.join(tmpdir,"schedule.sqlite")
+
+    results = []
+    for size in [int(s) for s in options.sizes.split(",")]:
+      results.extend(bench_size(options,size))
+  finally:
+    shutil.rmtree(tmpdir)
+
+  report = {'date':    datetime.datetime.now().isoformat(timespec='seconds'),
+            'python':  platform.python_version(),
+            'sqlite':  sqlite3.sqlite_version,
+            'version': subprocess.run([sys.executable,script,"--version"],
+                                      stdout=subprocess.PIPE,
+                                      universal_newlines=True).stdout.strip(),
+            'repeat':  options.repeat,
+            'results': results}
+  if options.output:
+    with open(options.output,"w") as f:
+      json.dump(report,f,indent=2)
+  else:
+    json.dump(report,sys.stdout,indent=2)
+    print()
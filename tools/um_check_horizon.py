@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# Uptime-Manager: check that aggregate_rows() of um_ctrl.py stops early only
+# after the next halt and boot, i.e. it gives the same next halt and boot as
+# an aggregation over the whole time-horizon
+#
+# Author: Bernhard Bablok
+# License: GPL3
+#
+# Website: https://github.com/bablokb/uptime-manager
+#
+# --------------------------------------------------------------------------
+
+DEFAULT_RUNS   = 5000
+DEFAULT_SCRIPT = "../files/usr/local/sbin/um_ctrl.py"   # relative to tools
+
+TODAY        = 20743             # 16.10.2026 (epoch-day)
+TIME_HORIZON = 366
+
+# schedules which failed before (rows, now, min_downtime)
+CASES = [
+  ([('DOM',17,None,None,79200,7200)],82800,10),    # monthly, past midnight
+  ([('DOW',6,None,None,79200,7200)],82800,10),     # weekly, past midnight
+  ([('DOM',31,None,None,82800,3600)],0,10),        # halt at 23:59:59
+  ([('DOM',17,None,None,0,3600),
+    ('DOM',16,None,None,82800,0)],0,10),           # boot at 00:00
+  ([('DOW',3,None,None,36300,0),
+    ('DOM',24,None,None,0,18300)],0,10),           # halt at 00:00
+  ]
+
+# --- system-imports   -----------------------------------------------------
+
+import argparse
+import sys, os, random, importlib.util
+
+# --- load um_ctrl.py as a module   -----------------------------------------
+
+def load_script(path):
+  """ import um_ctrl.py from the given path """
+
+  spec   = importlib.util.spec_from_file_location("um_ctrl",path)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+# --- next halt and boot   --------------------------------------------------
+
+def next_events(um_ctrl,aggregated,now,min_downtime):
+  """ return (halt,boot) after now as (day,time) like consolidate_uptimes()
+      and next_event() (without grace-periods) """
+
+  states,first_boot = [],True
+  for (day,time,state,candidate) in aggregated:
+    if not candidate:
+      states.append((day,time,state))
+    elif first_boot and time > now:
+      states.append((day,time,state))
+      first_boot = False
+  states = um_ctrl.merge_uptimes(states,TODAY,now,min_downtime)
+
+  result = {}
+  for (day,time,state) in states:
+    if state not in result and (0 if day > TODAY else now) < time:
+      result[state] = (day,time)
+  return result.get(0),result.get(1)
+
+# --- compare with the whole time-horizon   ---------------------------------
+
+def check(um_ctrl,rows,now,min_downtime):
+  """ return (expected,result) of next halt and boot """
+
+  result = next_events(um_ctrl,
+    um_ctrl.aggregate_rows(rows,TODAY,TIME_HORIZON,min_downtime),
+    now,min_downtime)
+  # reference: no early stop within the time-horizon
+  saved,um_ctrl.TIME_HORIZON = um_ctrl.TIME_HORIZON,TIME_HORIZON
+  try:
+    expected = next_events(um_ctrl,
+      um_ctrl.aggregate_rows(rows,TODAY,TIME_HORIZON,min_downtime),
+      now,min_downtime)
+  finally:
+    um_ctrl.TIME_HORIZON = saved
+  return expected,result
+
+# --- create random schedule   ----------------------------------------------
+
+def create_rows(rnd):
+  """ return rows (type,value,since,until,start,end) of a few entries,
+      mostly rare ones (DOM, DATE) and often spanning midnight """
+
+  rows = []
+  for _ in range(rnd.randint(1,4)):
+    dtype = rnd.choice(['DOW','DOM','DOM','DATE'])
+    if dtype == 'DOW':
+      value = rnd.randint(1,7)
+    elif dtype == 'DOM':
+      value = rnd.randint(1,31)
+    else:
+      value = TODAY + rnd.randint(-1,60)
+    start = rnd.choice([0,rnd.randrange(0,86400,300)])
+    if rnd.random() < 0.4:
+      end = rnd.choice([0,rnd.randrange(0,start+1,300)])   # past midnight
+    else:
+      end = min(start + rnd.randrange(300,6*3600,300),86399)
+    rows.append((dtype,value,None,value if dtype == 'DATE' else None,
+                 start,end))
+  return rows
+
+# --- commandline parser   --------------------------------------------------
+
+def get_parser():
+  parser = argparse.ArgumentParser(
+    description='check the early stop of aggregate_rows() of um_ctrl.py')
+  parser.add_argument('-r', '--runs', type=int, default=DEFAULT_RUNS,
+    dest='runs', help='number of random schedules (default: %d)' %
+                      DEFAULT_RUNS)
+  parser.add_argument('--seed', type=int, default=42, dest='seed',
+    help='seed for the random schedules')
+  parser.add_argument('--script', default=None, dest='script',
+    help='path to um_ctrl.py (default: the one in this repository)')
+  return parser
+
+# --- main program   --------------------------------------------------------
+
+if __name__ == '__main__':
+  options = get_parser().parse_args()
+  script  = options.script or os.path.join(os.path.dirname(
+    os.path.abspath(__file__)),DEFAULT_SCRIPT)
+  um_ctrl = load_script(script)
+
+  rnd   = random.Random(options.seed)
+  cases = CASES + [(create_rows(rnd),rnd.randrange(86400),
+                    rnd.choice([0,1,10,60,180]))
+                   for _ in range(options.runs)]
+  failed = 0
+  for rows,now,min_downtime in cases:
+    expected,result = check(um_ctrl,rows,now,min_downtime)
+    if result != expected:
+      failed += 1
+      if failed <= 5:
+        print("mismatch: now=%d, min_downtime=%d\n  rows:     %r\n"
+              "  expected: %r\n  result:   %r" %
+              (now,min_downtime,rows,expected,result))
+  print("%d of %d schedules differ" % (failed,len(cases)))
+  sys.exit(1 if failed else 0)
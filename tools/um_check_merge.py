@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# Uptime-Manager: check merge_uptimes() of um_ctrl.py against the old
+# del-in-place consolidation with random lists of state-changes. The old
+# loop is kept unchanged, the state-changes are converted to sql-dates and
+# time-strings for it
+#
+# Author: Bernhard Bablok
+# License: GPL3
+#
+# Website: https://github.com/bablokb/uptime-manager
+#
+# --------------------------------------------------------------------------
+
+DEFAULT_RUNS   = 20000
+DEFAULT_SCRIPT = "../files/usr/local/sbin/um_ctrl.py"   # relative to tools
+
+# --- system-imports   -----------------------------------------------------
+
+import argparse
+import sys, os, random, datetime, importlib.util
+
+# --- load um_ctrl.py as a module   -----------------------------------------
+
+def load_script(path):
+  """ import um_ctrl.py from the given path """
+
+  spec   = importlib.util.spec_from_file_location("um_ctrl",path)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+# --- reference implementation   --------------------------------------------
+
+def sql2datetime(date,time):
+  """ return date of given sql-date (as in the old um_ctrl.py) """
+
+  return datetime.datetime.strptime("%s %s" % (date,time), "%Y-%m-%d %H:%M:%S")
+
+def merge_old(options,result,now):
+  """ consolidation before the single pass (deletes list-items in place)
+
+      This is the original loop of consolidate_uptimes(), unchanged: the
+      state-changes are (sql-date,time,state) and now is a time-string.
+      The state-changes must start today (it uses datetime.date.today()).
+  """
+
+  # now we consolidate the periods
+  delta = datetime.timedelta(minutes=options.min_downtime)
+  i = 0
+  day = datetime.date.today().strftime("%Y-%m-%d")
+  while True and len(result):
+    if i >= len(result)-1:
+      break
+    (day_c,time_c,state_c) = result[i]
+    logger.msg("TRACE","examining: %s,%s,%d" % (day_c,time_c,state_c))
+    if day_c == day and time_c < now:
+      # skip events in the past
+      del result[i]    # deletes current entry
+      continue
+    if state_c:
+      # never remove an up-event
+      i += 1
+      continue
+    (day_n,time_n,state_n) = result[i+1]
+    dt_c = sql2datetime(day_c,time_c)
+    dt_n = sql2datetime(day_n,time_n)
+    if (dt_c + delta > dt_n):
+      logger.msg("TRACE","deleting %r" % (result[i],))
+      del result[i]    # deletes current down
+      logger.msg("TRACE","deleting %r" % (result[i],))
+      del result[i]    # deletes next up
+    else:
+      # skip to next down
+      i += 2
+  return result
+
+def merge_reference(um_ctrl,states,now,min_downtime):
+  """ run merge_old() on state-changes with epoch-days and seconds """
+
+  options = argparse.Namespace(min_downtime=min_downtime)
+  result  = merge_old(options,
+                      [(um_ctrl.day2sql(day),um_ctrl.secs2time(time),state)
+                       for (day,time,state) in states],
+                      um_ctrl.secs2time(now))
+  return [(um_ctrl.sql2day(day),um_ctrl.time2secs(time),state)
+          for (day,time,state) in result]
+
+# --- create random state-changes   -----------------------------------------
+
+def create_states(rnd,today):
+  """ return (states,now,min_downtime) with sorted state-changes
+
+      The lists start today (partly before now), have short and long
+      downtimes and sometimes consecutive up-events (candidates).
+  """
+
+  now   = rnd.randrange(86400)
+  day   = today
+  time  = rnd.randrange(86400)
+  state = rnd.randint(0,1)
+  states = []
+  for _ in range(rnd.randint(0,30)):
+    states.append((day,time,state))
+    step = rnd.choice([1,60,300,599,600,601,3600,rnd.randrange(2*86400)])
+    time += step
+    day,time = day + time // 86400,time % 86400
+    if rnd.random() < 0.9:
+      state = 1 - state
+  return states,now,rnd.choice([0,1,5,10,30,60])
+
+# --- commandline parser   --------------------------------------------------
+
+def get_parser():
+  parser = argparse.ArgumentParser(
+    description='check merge_uptimes() of um_ctrl.py against the old loop')
+  parser.add_argument('-r', '--runs', type=int, default=DEFAULT_RUNS,
+    dest='runs', help='number of random lists (default: %d)' % DEFAULT_RUNS)
+  parser.add_argument('--seed', type=int, default=42, dest='seed',
+    help='seed for the random lists')
+  parser.add_argument('--script', default=None, dest='script',
+    help='path to um_ctrl.py (default: the one in this repository)')
+  return parser
+
+# --- main program   --------------------------------------------------------
+
+if __name__ == '__main__':
+  options = get_parser().parse_args()
+  script  = options.script or os.path.join(os.path.dirname(
+    os.path.abspath(__file__)),DEFAULT_SCRIPT)
+  um_ctrl = load_script(script)
+  logger  = um_ctrl.logger
+
+  rnd   = random.Random(options.seed)
+  today = um_ctrl.date2day(datetime.date.today())
+  failed = 0
+  for _ in range(options.runs):
+    states,now,min_downtime = create_states(rnd,today)
+    expected = merge_reference(um_ctrl,states,now,min_downtime)
+    result   = um_ctrl.merge_uptimes(states,today,now,min_downtime)
+    if result != expected:
+      failed += 1
+      if failed <= 5:
+        print("mismatch: now=%d, min_downtime=%d\n  states:   %r\n"
+              "  expected: %r\n  result:   %r" %
+              (now,min_downtime,states,expected,result))
+  print("%d of %d lists differ" % (failed,options.runs))
+  sys.exit(1 if failed else 0)